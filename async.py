@@ -10,6 +10,7 @@ import datetime
 import uuid
 
 import main
+import search
 from util import StringLogOutput
 
 from google.appengine.ext import deferred
@@ -38,17 +39,42 @@ def runSolver(settings, progressFeedback=None):
 
         logOutput.write("Seed: %i, Use Conditions: %s\n\n" % (seed, synth.useConditions))
 
-        logOutput.write("Genetic Program Result\n")
-        logOutput.write("======================\n")
-
-        best, finalState, _, _, _ = main.mainGP(synth, settings['solver']['penaltyWeight'], settings['solver']['population'],
-                                       settings['solver']['generations'], seed, sequence, logOutput=logOutput,
-                                       progressFeedback=progressFeedback)
+        engine = settings['solver'].get('engine', "gp")
+        if engine == "beam":
+            logOutput.write("Beam Search Result\n")
+            logOutput.write("==================\n")
+
+            best, finalState, _, _, _, runInfo = search.beamSearch(synth, settings['solver']['penaltyWeight'],
+                                           beamWidth=settings['solver'].get('beamWidth', 100),
+                                           maxLength=settings['solver'].get('maxLength', 50), logOutput=logOutput,
+                                           progressFeedback=progressFeedback,
+                                           timeLimit=settings['solver'].get('timeLimit'))
+        elif engine == "gp":
+            logOutput.write("Genetic Program Result\n")
+            logOutput.write("======================\n")
+
+            best, finalState, _, _, _, runInfo = main.mainGP(synth, settings['solver']['penaltyWeight'], settings['solver']['population'],
+                                           settings['solver'].get('generations'), seed, sequence, logOutput=logOutput,
+                                           progressFeedback=progressFeedback, batchEvaluate=True,
+                                           genome=settings['solver'].get('genome', "tree"),
+                                           maxLength=settings['solver'].get('maxLength', 50),
+                                           parsimonySize=settings['solver'].get('parsimonySize'),
+                                           stagnationGenerations=settings['solver'].get('stagnationGenerations'),
+                                           minFitnessStd=settings['solver'].get('minFitnessStd'),
+                                           stopAtMaxQuality=settings['solver'].get('stopAtMaxQuality', False),
+                                           timeLimit=settings['solver'].get('timeLimit'),
+                                           maxEvaluations=settings['solver'].get('maxEvaluations'))
+        else:
+            raise ValueError("Unknown solver engine: %s" % engine)
 
         logOutput.write("\nMonte Carlo Result\n")
         logOutput.write("==================\n")
 
-        main.MonteCarloSim(best, synth, nRuns=settings['maxMontecarloRuns'], seed=seed, logOutput=logOutput)
+        result["monteCarlo"] = main.MonteCarloSim(best, synth, nRuns=settings['maxMontecarloRuns'], seed=seed,
+                                                  logOutput=logOutput, vectorized=True, hqMode="analytic",
+                                                  percentiles=(5, 50, 95), confidence=0.95,
+                                                  hqPrecision=settings.get('montecarloHqPrecision'),
+                                                  qualityPrecision=settings.get('montecarloQualityPrecision')).toDict()
 
         result["finalState"] = {
             "durability": finalState.durabilityState,
@@ -60,6 +86,9 @@ def runSolver(settings, progressFeedback=None):
             "quality": finalState.qualityState,
         }
         result["bestSequence"] = [a.shortName for a in best]
+        result["generations"] = runInfo["generations"]
+        result["stopReason"] = runInfo["stopReason"]
+        result["evaluationsPerSecond"] = runInfo["evaluationsPerSecond"]
     except Exception as e:
         result["error"] = str(e)
         logging.exception(e)
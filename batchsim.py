@@ -0,0 +1,521 @@
+"""NumPy batch simulation engines.
+
+The Monte Carlo engine runs every trial of one action sequence together, with
+the state of each trial held as one element of a set of arrays. It follows the
+same rules as main.MonteCarloSynth.
+
+The expected value engine runs many different action sequences together. The
+sequences are padded into a 2-D array of action ids and each row follows the
+same rules as main.simSynth.
+"""
+
+import numpy as np
+
+import main
+import mcstats
+
+
+# Condition codes
+NORMAL = 0
+GOOD = 1
+EXCELLENT = 2
+POOR = 3
+
+# HQ% lookup table for hqPercentFromQualityArray
+hqQualityThresholds = np.array(main.hqQualityThresholds)
+
+# Level difference modes
+LEVEL_NORMAL = 0
+LEVEL_INGENUITY = 1
+LEVEL_INGENUITY2 = 2
+
+
+class BatchState(object):
+    """Final states of a batch of simulation runs, one array element per run."""
+    def __init__(self, durabilityState, cpState, qualityState, progressState, wastedActions,
+                 progressOk, cpOk, durabilityOk, trickOk, crossClassCount=None):
+        self.durabilityState = durabilityState
+        self.cpState = cpState
+        self.qualityState = qualityState
+        self.progressState = progressState
+        self.wastedActions = wastedActions
+        self.progressOk = progressOk
+        self.cpOk = cpOk
+        self.durabilityOk = durabilityOk
+        self.trickOk = trickOk
+        self.crossClassCount = crossClassCount
+
+    def __len__(self):
+        return len(self.qualityState)
+
+
+def hqPercentFromQualityArray(qualityPercent):
+    """Array version of main.hqPercentFromQuality."""
+    qualityPercent = np.asarray(qualityPercent, dtype=float)
+    hqPercent = np.minimum(np.searchsorted(hqQualityThresholds, qualityPercent) + 1, 100)
+    hqPercent[qualityPercent == 0] = 1
+    hqPercent[qualityPercent >= 100] = 100
+    return hqPercent
+
+
+def addToRunningStats(stats, values):
+    """Fold an array of values into a :class:`~mcstats.RunningStats`."""
+    if not len(values):
+        return
+    mean = values.mean()
+    stats.addSummary(len(values), float(mean), float(((values - mean)**2).sum()), values.min().item(), values.max().item())
+    if stats.sketch is not None:
+        for x in values.tolist():
+            stats.sketch.add(x)
+
+
+def levelDifferences(synth):
+    """Level difference used for each level difference mode."""
+    return [synth.crafter.level - synth.recipe.level, 0, 3]
+
+
+def baseProgressTable(synth):
+    """Base progress increase indexed by level difference mode."""
+    gainTables = synth.gainTables()
+    return np.array([gainTables.progress[ld] for ld in levelDifferences(synth)])
+
+
+def baseQualityTable(synth, maxIqStacks):
+    """Base quality increase indexed by [level difference mode, innovation, IQ stacks]."""
+    gainTables = synth.gainTables()
+    table = np.zeros((3, 2, maxIqStacks + 1))
+    for mode, ld in enumerate(levelDifferences(synth)):
+        for innov in range(2):
+            for iq in range(maxIqStacks + 1):
+                table[mode, innov, iq] = gainTables.baseQuality(ld, iq, innov > 0)
+    return table
+
+
+def baseQualityIncrease(levelDifference, control):
+    """Array version of Synth.CalculateBaseQualityIncrease."""
+    levelCorrectionFactor = np.where((-5 <= levelDifference) & (levelDifference <= 0), 0.05 * levelDifference, 0)
+
+    baseQuality = 0.36 * control + 34
+    levelCorrectedQuality = baseQuality * (1 + levelCorrectionFactor)
+
+    # Round half away from zero like the builtin round
+    return np.floor(levelCorrectedQuality + 0.5)
+
+
+def actionArrays(synth):
+    """Per-action properties indexed by Action.id."""
+    table = main.actionTable
+    arrays = {
+        "successProbability": np.array([a.successProbability for a in table], dtype=float),
+        "qualityIncreaseMultiplier": np.array([a.qualityIncreaseMultiplier for a in table], dtype=float),
+        "progressIncreaseMultiplier": np.array([a.progressIncreaseMultiplier for a in table], dtype=float),
+        "durabilityCost": np.array([a.durabilityCost for a in table], dtype=float),
+        "cpCost": np.array([a.cpCost for a in table], dtype=float),
+        "isCountUp": np.array([a.type == "countup" for a in table]),
+        "isCountDown": np.array([a.type == "countdown" for a in table]),
+        "effectSlot": np.array([a.effectSlot for a in table]),
+        "activeTurns": np.array([getattr(a, "activeTurns", 0) for a in table]),
+        "isCrossClass": np.array([not (a.cls == "All" or a.cls == synth.crafter.cls) for a in table]),
+    }
+    return arrays
+
+
+def simSynthBatch(individuals, synth):
+    """Run the expected value simulation of many sequences at once.
+
+    :param individuals: List of sequences of Actions, of any lengths.
+    :param synth: The Synth to simulate.
+    :returns: A :class:`BatchState` with the final state of every sequence,
+              including the number of distinct cross class actions used.
+    """
+    nInds = len(individuals)
+    lengths = np.array([len(ind) for ind in individuals], dtype=int)
+    maxLength = lengths.max() if nInds else 0
+
+    # Pad the sequences into a 2-D array of action ids
+    actionIds = np.zeros((nInds, maxLength), dtype=int)
+    for i, ind in enumerate(individuals):
+        actionIds[i, :len(ind)] = [a.id for a in ind]
+
+    props = actionArrays(synth)
+    actionSuccessProbability = props["successProbability"]
+    actionQualityMultiplier = props["qualityIncreaseMultiplier"]
+    actionProgressMultiplier = props["progressIncreaseMultiplier"]
+    actionDurabilityCost = props["durabilityCost"]
+    actionCpCost = props["cpCost"]
+    actionIsCountUp = props["isCountUp"]
+    actionIsCountDown = props["isCountDown"]
+    actionEffectSlot = props["effectSlot"]
+    actionActiveTurns = props["activeTurns"]
+    actionIsCrossClass = props["isCrossClass"]
+
+    difficulty = synth.recipe.difficulty
+    maxDurability = synth.recipe.durability
+    maxCp = synth.crafter.craftPoints
+    rows = np.arange(nInds)
+
+    # State tracking
+    durabilityState = np.zeros(nInds) + maxDurability
+    cpState = np.zeros(nInds) + maxCp
+    progressState = np.zeros(nInds)
+    progressIsInt = np.ones(nInds, dtype=bool)     # Progress only grows by whole numbers so far
+    qualityState = np.zeros(nInds) + synth.recipe.startQuality
+    wastedActions = np.zeros(nInds, dtype=int)
+    trickUses = np.zeros(nInds, dtype=int)
+    iqActive = np.zeros(nInds, dtype=bool)
+    iqStacks = np.zeros(nInds)
+    countDowns = np.zeros((nInds, main.nEffectSlots), dtype=int)
+    crossClassUsed = np.zeros((nInds, len(main.actionTable)), dtype=bool)
+
+    # Conditions
+    pGood = 0.23
+    pExcellent = 0.01
+
+    # Step 1 is always normal
+    ppGood = np.zeros(nInds)
+    ppExcellent = np.zeros(nInds)
+    ppPoor = np.zeros(nInds)
+    ppNormal = 1 - (ppGood + ppExcellent + ppPoor)
+
+    innovationSlot = main.innovation.effectSlot
+    ingenuitySlot = main.ingenuity.effectSlot
+    ingenuity2Slot = main.ingenuity2.effectSlot
+    steadyHandSlot = main.steadyHand.effectSlot
+    steadyHand2Slot = main.steadyHand2.effectSlot
+    greatStridesSlot = main.greatStrides.effectSlot
+    wasteNotSlot = main.wasteNot.effectSlot
+    wasteNot2Slot = main.wasteNot2.effectSlot
+    manipulationSlot = main.manipulation.effectSlot
+    comfortZoneSlot = main.comfortZone.effectSlot
+
+    levelDifferenceTable = np.array(levelDifferences(synth))
+    progressTable = baseProgressTable(synth)
+
+    for step in range(maxLength):
+        action = actionIds[:, step]
+        valid = step < lengths
+
+        # Add effect modifiers
+        control = np.zeros(nInds) + synth.crafter.control
+        control = np.where(iqActive, control * (1 + 0.2 * iqStacks), control)
+        control[countDowns[:, innovationSlot] > 0] *= 1.5
+
+        levelMode = np.zeros(nInds, dtype=int)
+        levelMode[countDowns[:, ingenuitySlot] > 0] = LEVEL_INGENUITY
+        levelMode[countDowns[:, ingenuity2Slot] > 0] = LEVEL_INGENUITY2
+        levelDifference = levelDifferenceTable[levelMode]
+
+        successProbability = actionSuccessProbability[action].copy()
+        successProbability[countDowns[:, steadyHandSlot] > 0] += 0.2
+        steadyHand2Active = countDowns[:, steadyHand2Slot] > 0
+        successProbability[steadyHand2Active] = actionSuccessProbability[action][steadyHand2Active] + 0.3
+        successCapped = successProbability > 1
+        successProbability = np.minimum(successProbability, 1)
+
+        qualityIncreaseMultiplier = actionQualityMultiplier[action].copy()
+        qualityIncreaseMultiplier[countDowns[:, greatStridesSlot] > 0] *= 2
+
+        # Condition Calculation
+        if synth.useConditions:
+            qualityIncreaseMultiplier *= (1*ppNormal + 1.5*ppGood + 4*ppExcellent + 0.5*ppPoor)
+
+        # Calculate final gains / losses
+        bProgressGain = actionProgressMultiplier[action] * progressTable[levelMode]
+        isFlawless = action == main.flawlessSynthesis.id
+        bProgressGain[isFlawless] = 40
+        isPieceByPiece = action == main.pieceByPiece.id
+        if isPieceByPiece.any():
+            # Divide whole-number progress the same way simSynth does
+            remainingProgress = difficulty - progressState
+            pieceGain = np.where(progressIsInt, remainingProgress.astype(int)/3, remainingProgress/3)
+            bProgressGain[isPieceByPiece] = pieceGain[isPieceByPiece]
+        progressGain = successProbability * bProgressGain
+
+        bQualityGain = qualityIncreaseMultiplier * baseQualityIncrease(levelDifference, control)
+        qualityGain = successProbability * bQualityGain
+        isByregots = action == main.byregotsBlessing.id
+        qualityGain = np.where(isByregots & iqActive, qualityGain * (1 + 0.2 * iqStacks), qualityGain)
+
+        durabilityCost = actionDurabilityCost[action].copy()
+        durabilityCost[(countDowns[:, wasteNotSlot] > 0) | (countDowns[:, wasteNot2Slot] > 0)] *= 0.5
+
+        # Wasted actions
+        finished = (progressState >= difficulty) | (durabilityState <= 0)
+        wasted = valid & finished & (action != main.dummyAction.id)
+        wastedActions += wasted
+        live = valid & ~wasted
+
+        # State tracking
+        progressState = np.where(live, progressState + progressGain, progressState)
+        # Only whole gains at a capped success probability keep progress a whole number
+        progressIsInt &= ~live | ((isFlawless | isPieceByPiece) & successCapped)
+        qualityState = np.where(live, qualityState + qualityGain, qualityState)
+        durabilityState = np.where(live, durabilityState - durabilityCost, durabilityState)
+        cpState = np.where(live, cpState - actionCpCost[action], cpState)
+
+        # Effect management
+        durabilityState[live & (action == main.mastersMend.id)] += 30
+        durabilityState[live & (action == main.mastersMend2.id)] += 60
+        durabilityState[live & (countDowns[:, manipulationSlot] > 0) & (durabilityState > 0)] += 10
+        cpState[live & (countDowns[:, comfortZoneSlot] > 0) & (cpState > 0)] += 8
+
+        ruminate = live & (action == main.rumination.id) & (cpState > 0)
+        restore = ruminate & iqActive & (iqStacks > 0)
+        cpState[restore] += (21 * iqStacks[restore] - iqStacks[restore]**2 + 10)/2
+        iqActive[restore] = False
+        wastedActions += ruminate & ~restore
+
+        blessing = live & isByregots
+        wastedActions += blessing & ~iqActive
+        iqActive[blessing] = False
+
+        isTouch = actionQualityMultiplier[action] > 0
+        countDowns[live & isTouch, greatStridesSlot] = 0
+
+        trick = live & (action == main.tricksOfTheTrade.id) & (cpState > 0)
+        trickUses += trick
+        cpState[trick] += 20
+
+        # Conditions
+        if synth.useConditions:
+            ppPoor = np.where(live, ppExcellent, ppPoor)
+            ppGood = np.where(live, pGood * ppNormal, ppGood)
+            ppExcellent = np.where(live, pExcellent * ppNormal, ppExcellent)
+            ppNormal = 1 - (ppGood + ppExcellent + ppPoor)
+
+        # Decrement countdowns
+        countDowns[live] -= countDowns[live] > 0
+
+        # Increment countups
+        grow = live & isTouch & iqActive
+        iqStacks[grow] += successProbability[grow]
+
+        # Initialize new effects after countdowns are managed to reset them properly
+        # Inner Quiet is the only countup effect
+        start = live & actionIsCountUp[action]
+        iqActive[start] = True
+        iqStacks[start] = 0
+
+        start = live & actionIsCountDown[action]
+        countDowns[rows[start], actionEffectSlot[action[start]]] = actionActiveTurns[action[start]]
+
+        # Sanity checks for state variables
+        durabilityState = np.where(live, np.minimum(durabilityState, maxDurability), durabilityState)
+        cpState = np.where(live, np.minimum(cpState, maxCp), cpState)
+
+        # Count cross class actions
+        crossClass = live & actionIsCrossClass[action]
+        crossClassUsed[rows[crossClass], action[crossClass]] = True
+
+    # Penalise failure outcomes
+    nonEmpty = lengths > 0
+    progressOk = nonEmpty & (progressState >= difficulty)
+    cpOk = nonEmpty & (cpState >= 0)
+    durabilityOk = nonEmpty & (durabilityState >= 0) & progressOk
+    trickOk = nonEmpty & (trickUses <= synth.maxTrickUses)
+
+    return BatchState(durabilityState, cpState, qualityState, progressState, wastedActions,
+                      progressOk, cpOk, durabilityOk, trickOk, crossClassUsed.sum(axis=1))
+
+
+def numpySeed(seed):
+    """Reduce any seed that :class:`random.Random` accepts to one that
+    :class:`numpy.random.RandomState` accepts. Seeds that already fit are
+    kept, so their streams do not change.
+
+    >>> numpySeed(19770216)
+    19770216
+    >>> numpySeed(2**40 + 5)
+    5
+    >>> numpySeed(-1)
+    4294967295
+    >>> numpySeed(None) is None
+    True
+    """
+    if seed is None:
+        return None
+    return seed % 2**32
+
+
+def monteCarloBatch(individual, synth, nRuns, seed=None):
+    """Run nRuns Monte Carlo simulations of individual at once.
+
+    :param individual: Sequence of Actions.
+    :param synth: The Synth to simulate.
+    :param nRuns: The number of trials.
+    :param seed: Seed for the NumPy random generator, reduced by
+                 :func:`numpySeed`.
+    :returns: A :class:`BatchState` with the final state of every trial.
+    """
+    rand = np.random.RandomState(numpySeed(seed))
+
+    # Strip Tricks of the Trade
+    individual = [x for x in individual if x.id != main.tricksOfTheTrade.id]
+
+    difficulty = synth.recipe.difficulty
+    maxDurability = synth.recipe.durability
+    maxCp = synth.crafter.craftPoints
+    maxTricksUses = synth.maxTrickUses
+
+    # Conditions
+    pGood = 0.23
+    pExcellent = 0.01
+
+    # State tracking
+    durabilityState = np.zeros(nRuns) + maxDurability
+    cpState = np.zeros(nRuns) + maxCp
+    progressState = np.zeros(nRuns)
+    progressIsInt = np.ones(nRuns, dtype=bool)     # Progress only grows by whole numbers so far
+    qualityState = np.zeros(nRuns) + synth.recipe.startQuality
+    wastedActions = np.zeros(nRuns, dtype=int)
+    trickUses = np.zeros(nRuns, dtype=int)
+    condition = np.zeros(nRuns, dtype=int)
+    iqActive = np.zeros(nRuns, dtype=bool)
+    iqStacks = np.zeros(nRuns, dtype=int)
+    countDowns = np.zeros((main.nEffectSlots, nRuns), dtype=int)
+
+    innovationSlot = main.innovation.effectSlot
+    ingenuitySlot = main.ingenuity.effectSlot
+    ingenuity2Slot = main.ingenuity2.effectSlot
+    steadyHandSlot = main.steadyHand.effectSlot
+    steadyHand2Slot = main.steadyHand2.effectSlot
+    greatStridesSlot = main.greatStrides.effectSlot
+    wasteNotSlot = main.wasteNot.effectSlot
+    wasteNot2Slot = main.wasteNot2.effectSlot
+    manipulationSlot = main.manipulation.effectSlot
+    comfortZoneSlot = main.comfortZone.effectSlot
+
+    progressTable = baseProgressTable(synth)
+    qualityTable = baseQualityTable(synth, len(individual))
+
+    for action in individual:
+        actionId = action.id
+
+        # Add effect modifiers
+        levelMode = np.zeros(nRuns, dtype=int)
+        levelMode[countDowns[ingenuitySlot] > 0] = LEVEL_INGENUITY
+        levelMode[countDowns[ingenuity2Slot] > 0] = LEVEL_INGENUITY2
+        innovationActive = (countDowns[innovationSlot] > 0).astype(int)
+
+        successProbability = np.zeros(nRuns) + action.successProbability
+        successProbability[countDowns[steadyHandSlot] > 0] += 0.2
+        successProbability[countDowns[steadyHand2Slot] > 0] = action.successProbability + 0.3
+        successProbability = np.minimum(successProbability, 1)
+
+        qualityIncreaseMultiplier = np.zeros(nRuns) + action.qualityIncreaseMultiplier
+        qualityIncreaseMultiplier[countDowns[greatStridesSlot] > 0] *= 2
+
+        # Condition Calculation
+        wasExcellent = condition == EXCELLENT
+        wasNormal = condition == NORMAL
+        condRand = rand.random_sample(nRuns)
+        condition = np.zeros(nRuns, dtype=int)
+        condition[wasExcellent] = POOR
+        condition[wasNormal & (condRand < pExcellent)] = EXCELLENT
+        condition[wasNormal & (condRand >= pExcellent) & (condRand < pExcellent + pGood)] = GOOD
+
+        qualityIncreaseMultiplier[condition == POOR] *= 0.5
+        qualityIncreaseMultiplier[condition == EXCELLENT] *= 4
+
+        # Assumes first N good actions will always be used for ToT
+        isGood = condition == GOOD
+        useTrick = isGood & (trickUses < maxTricksUses)
+        trickUses += useTrick
+        cpState[useTrick] += 20
+        qualityIncreaseMultiplier[isGood & ~useTrick] *= 1.5
+
+        # Calculate final gains / losses
+        success = (rand.random_sample(nRuns) <= successProbability).astype(int)
+
+        if actionId == main.flawlessSynthesis.id:
+            bProgressGain = 40
+        elif actionId == main.pieceByPiece.id:
+            # Divide whole-number progress the same way MonteCarloSynth does
+            remainingProgress = difficulty - progressState
+            bProgressGain = np.where(progressIsInt, remainingProgress.astype(int)/3, remainingProgress/3)
+        else:
+            bProgressGain = action.progressIncreaseMultiplier * progressTable[levelMode]
+        progressGain = success * bProgressGain
+
+        iqIndex = np.where(iqActive, iqStacks, 0)
+        bQualityGain = qualityIncreaseMultiplier * qualityTable[levelMode, innovationActive, iqIndex]
+        qualityGain = success * bQualityGain
+        if actionId == main.byregotsBlessing.id:
+            qualityGain = np.where(iqActive, qualityGain * (1 + 0.2 * iqStacks), qualityGain)
+
+        durabilityCost = np.zeros(nRuns) + action.durabilityCost
+        durabilityCost[(countDowns[wasteNotSlot] > 0) | (countDowns[wasteNot2Slot] > 0)] = 0.5 * action.durabilityCost
+
+        # Wasted actions
+        if actionId == main.dummyAction.id:
+            live = np.ones(nRuns, dtype=bool)
+        else:
+            live = (progressState < difficulty) & (durabilityState > 0)
+            wastedActions += ~live
+
+        # State tracking
+        progressState = np.where(live, progressState + progressGain, progressState)
+        if actionId != main.flawlessSynthesis.id and actionId != main.pieceByPiece.id:
+            progressIsInt &= ~live
+        qualityState = np.where(live, qualityState + qualityGain, qualityState)
+        durabilityState = np.where(live, durabilityState - durabilityCost, durabilityState)
+        cpState[live] -= action.cpCost
+
+        # Effect management
+        if actionId == main.mastersMend.id:
+            durabilityState[live] += 30
+
+        if actionId == main.mastersMend2.id:
+            durabilityState[live] += 60
+
+        durabilityState[live & (countDowns[manipulationSlot] > 0) & (durabilityState > 0)] += 10
+
+        cpState[live & (countDowns[comfortZoneSlot] > 0) & (cpState > 0)] += 8
+
+        if actionId == main.rumination.id:
+            ruminate = live & (cpState > 0)
+            restore = ruminate & iqActive & (iqStacks > 0)
+            cpState[restore] += (21 * iqStacks[restore] - iqStacks[restore]**2 + 10)/2
+            iqActive[restore] = False
+            wastedActions += ruminate & ~restore
+
+        if actionId == main.byregotsBlessing.id:
+            wastedActions += live & ~iqActive
+            iqActive[live] = False
+
+        if action.qualityIncreaseMultiplier > 0:
+            countDowns[greatStridesSlot][live] = 0
+
+        # Decrement countdowns
+        countDowns[:, live] -= countDowns[:, live] > 0
+
+        # Increment countups
+        if action.qualityIncreaseMultiplier > 0:
+            iqStacks += live & iqActive & (success > 0)
+
+        # Initialize new effects after countdowns are managed to reset them properly
+        # Inner Quiet is the only countup effect
+        if action.type == "countup":
+            iqActive[live] = True
+            iqStacks[live] = 0
+
+        if action.type == "countdown":
+            countDowns[action.effectSlot][live] = action.activeTurns
+
+        # Sanity checks for state variables
+        durabilityState = np.where(live, np.minimum(durabilityState, maxDurability), durabilityState)
+        cpState = np.where(live, np.minimum(cpState, maxCp), cpState)
+
+    # Penalise failure outcomes
+    if not individual:
+        failed = np.zeros(nRuns, dtype=bool)
+        return BatchState(durabilityState, cpState, qualityState, progressState, wastedActions,
+                          failed, failed, failed, failed)
+
+    progressOk = progressState >= difficulty
+    cpOk = cpState >= 0
+    durabilityOk = (durabilityState >= 0) & progressOk
+    trickOk = trickUses <= synth.maxTrickUses
+
+    return BatchState(durabilityState, cpState, qualityState, progressState, wastedActions,
+                      progressOk, cpOk, durabilityOk, trickOk)
@@ -29,7 +29,7 @@ import random
 
 import tools
 
-def varAnd(population, toolbox, cxpb, mutpb):
+def varAnd(population, toolbox, cxpb, mutpb, rng=None):
     """Part of an evolutionary algorithm applying only the variation part
     (crossover **and** mutation). The modified individuals have their
     fitness invalidated. The individuals are cloned so returned population is
@@ -40,6 +40,8 @@ def varAnd(population, toolbox, cxpb, mutpb):
                     operators.
     :param cxpb: The probability of mating two individuals.
     :param mutpb: The probability of mutating an individual.
+    :param rng: A :class:`random.Random` instance to draw from, the
+                :mod:`random` module when :obj:`None` (default).
     :returns: A list of varied individuals that are independent of their
               parents.
     
@@ -64,23 +66,25 @@ def varAnd(population, toolbox, cxpb, mutpb):
     according to the given probabilities. Both probabilities should be in
     :math:`[0, 1]`.
     """
+    if rng is None:
+        rng = random
     offspring = [toolbox.clone(ind) for ind in population]
     
     # Apply crossover and mutation on the offspring
     for i in range(1, len(offspring), 2):
-        if random.random() < cxpb:
+        if rng.random() < cxpb:
             offspring[i-1], offspring[i] = toolbox.mate(offspring[i-1], offspring[i])
             del offspring[i-1].fitness.values, offspring[i].fitness.values
     
     for i in range(len(offspring)):
-        if random.random() < mutpb:
+        if rng.random() < mutpb:
             offspring[i], = toolbox.mutate(offspring[i])
             del offspring[i].fitness.values
     
     return offspring
 
 def eaSimple(population, toolbox, cxpb, mutpb, ngen, stats=None,
-             halloffame=None, verbose=__debug__):
+             halloffame=None, verbose=__debug__, rng=None):
     """This algorithm reproduce the simplest evolutionary algorithm as
     presented in chapter 7 of [Back2000]_.
     
@@ -95,6 +99,8 @@ def eaSimple(population, toolbox, cxpb, mutpb, ngen, stats=None,
     :param halloffame: A :class:`~deap.tools.HallOfFame` object that will
                        contain the best individuals, optional.
     :param verbose: Whether or not to log the statistics.
+    :param rng: A :class:`random.Random` instance to draw from, the
+                :mod:`random` module when :obj:`None` (default).
     :returns: The final population.
     
     It uses :math:`\lambda = \kappa = \mu` and goes as follow.
@@ -149,7 +155,7 @@ def eaSimple(population, toolbox, cxpb, mutpb, ngen, stats=None,
         offspring = toolbox.select(population, len(population))
         
         # Variate the pool of individuals
-        offspring = varAnd(offspring, toolbox, cxpb, mutpb)
+        offspring = varAnd(offspring, toolbox, cxpb, mutpb, rng)
         
         # Evaluate the individuals with an invalid fitness
         invalid_ind = [ind for ind in offspring if not ind.fitness.valid]
@@ -143,6 +143,19 @@ def create(name, base, **kargs):
     The :ref:`creating-types` tutorial gives more examples of the creator
     usage.
     """
+    globals()[name] = createType(name, base, **kargs)
+
+def createType(name, base, **kargs):
+    """Creates a new class like :func:`create` does, but returns it instead of
+    adding it to the :mod:`~deap.creator` module. Independent types of the
+    same name can thus coexist, for example one per primitive set.
+    
+    :param name: The name of the class to create.
+    :param base: A base class from which to inherit.
+    :param attribute: One or more attributes to add on instanciation of this
+                      class, optional.
+    :returns: The new class.
+    """
     dict_inst = {}
     dict_cls = {}
     for obj_name, obj in kargs.iteritems():
@@ -173,4 +186,4 @@ def create(name, base, **kargs):
 
     objtype = type(name, (base,), dict_cls)
     objtype.__init__ = initType
-    globals()[name] = objtype
+    return objtype
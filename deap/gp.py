@@ -397,7 +397,7 @@ def lambdifyADF(expr):
 ######################################
 # GP Program generation functions    #
 ######################################
-def genFull(pset, min_, max_, type_=__type__):
+def genFull(pset, min_, max_, type_=__type__, rng=None):
     """Generate an expression where each leaf has a the same depth 
     between *min* and *max*.
     
@@ -406,14 +406,16 @@ def genFull(pset, min_, max_, type_=__type__):
     :param max_: Maximum Height of the produced trees.
     :param type_: The type that should return the tree when called, when
                   :obj:`None` (default) no return type is enforced.
+    :param rng: A :class:`random.Random` instance to draw from, the
+                :mod:`random` module when :obj:`None` (default).
     :returns: A full tree with all leaves at the same depth.
     """
     def condition(height, depth):
         """Expression generation stops when the depth is equal to height."""
         return depth == height
-    return generate(pset, min_, max_, condition, type_)
+    return generate(pset, min_, max_, condition, type_, rng)
 
-def genGrow(pset, min_, max_, type_=__type__):
+def genGrow(pset, min_, max_, type_=__type__, rng=None):
     """Generate an expression where each leaf might have a different depth 
     between *min* and *max*.
     
@@ -422,17 +424,21 @@ def genGrow(pset, min_, max_, type_=__type__):
     :param max_: Maximum Height of the produced trees.
     :param type_: The type that should return the tree when called, when
                   :obj:`None` (default) no return type is enforced.
+    :param rng: A :class:`random.Random` instance to draw from, the
+                :mod:`random` module when :obj:`None` (default).
     :returns: A grown tree with leaves at possibly different depths.
     """
+    if rng is None:
+        rng = random
     def condition(height, depth):
         """Expression generation stops when the depth is equal to height 
         or when it is randomly determined that a a node should be a terminal.
         """
         return depth == height or \
-               (depth >= min_ and random.random() < pset.terminalRatio)
-    return generate(pset, min_, max_, condition, type_)
+               (depth >= min_ and rng.random() < pset.terminalRatio)
+    return generate(pset, min_, max_, condition, type_, rng)
     
-def genRamped(pset, min_, max_, type_=__type__):
+def genRamped(pset, min_, max_, type_=__type__, rng=None):
     """Generate an expression with a PrimitiveSet *pset*.
     Half the time, the expression is generated with :func:`~deap.gp.genGrow`,
     the other half, the expression is generated with :func:`~deap.gp.genFull`.
@@ -442,12 +448,16 @@ def genRamped(pset, min_, max_, type_=__type__):
     :param max_: Maximum Height of the produced trees.
     :param type_: The type that should return the tree when called, when
                   :obj:`None` (default) no return type is enforced.
+    :param rng: A :class:`random.Random` instance to draw from, the
+                :mod:`random` module when :obj:`None` (default).
     :returns: Either, a full or a grown tree.
     """
-    method = random.choice((genGrow, genFull))
-    return method(pset, min_, max_, type_)
+    if rng is None:
+        rng = random
+    method = rng.choice((genGrow, genFull))
+    return method(pset, min_, max_, type_, rng)
 
-def generate(pset, min_, max_, condition, type_=__type__):
+def generate(pset, min_, max_, condition, type_=__type__, rng=None):
     """Generate a Tree as a list of list. The tree is build
     from the root to the leaves, and it stop growing when the
     condition is fulfilled.
@@ -460,17 +470,21 @@ def generate(pset, min_, max_, condition, type_=__type__):
                       depth in the tree.
     :param type_: The type that should return the tree when called, when
                   :obj:`None` (default) no return type is enforced.
+    :param rng: A :class:`random.Random` instance to draw from, the
+                :mod:`random` module when :obj:`None` (default).
     :returns: A grown tree with leaves at possibly different depths
               dependending on the condition function.
     """
+    if rng is None:
+        rng = random
     expr = []
-    height = random.randint(min_, max_)
+    height = rng.randint(min_, max_)
     stack = [(0, type_)]
     while len(stack) != 0:
         depth, type_ = stack.pop()
         if condition(height, depth):
             try:
-                term = random.choice(pset.terminals[type_])
+                term = rng.choice(pset.terminals[type_])
             except IndexError:
                 _, _, traceback = sys.exc_info()
                 raise IndexError, "The gp.generate function tried to add "\
@@ -481,7 +495,7 @@ def generate(pset, min_, max_, condition, type_=__type__):
             expr.append(term)
         else:
             try:
-                prim = random.choice(pset.primitives[type_])
+                prim = rng.choice(pset.primitives[type_])
             except IndexError:
                 _, _, traceback = sys.exc_info()                
                 raise IndexError, "The gp.generate function tried to add "\
@@ -497,14 +511,18 @@ def generate(pset, min_, max_, condition, type_=__type__):
 # GP Crossovers                      #
 ######################################
 
-def cxOnePoint(ind1, ind2):
+def cxOnePoint(ind1, ind2, rng=None):
     """Randomly select in each individual and exchange each subtree with the
     point as root between each individual.
     
     :param ind1: First tree participating in the crossover.
     :param ind2: Second tree participating in the crossover.
+    :param rng: A :class:`random.Random` instance to draw from, the
+                :mod:`random` module when :obj:`None` (default).
     :returns: A tuple of two trees.
     """
+    if rng is None:
+        rng = random
     if len(ind1) < 2 or len(ind2) < 2:
         # No crossover on single node tree
         return ind1, ind2
@@ -525,10 +543,10 @@ def cxOnePoint(ind1, ind2):
         common_types = set(types1.keys()).intersection(set(types2.keys()))
     
     if len(common_types) > 0:
-        type_ = random.choice(list(common_types))
+        type_ = rng.choice(list(common_types))
         
-        index1 = random.choice(types1[type_])
-        index2 = random.choice(types2[type_])
+        index1 = rng.choice(types1[type_])
+        index2 = rng.choice(types2[type_])
 
         slice1 = ind1.searchSubtree(index1)
         slice2 = ind2.searchSubtree(index2)
@@ -595,7 +613,7 @@ def cxOnePointLeafBiased(ind1, ind2, termpb):
 ######################################
 # GP Mutations                       #
 ######################################
-def mutUniform(individual, expr):
+def mutUniform(individual, expr, rng=None):
     """Randomly select a point in the tree *individual*, then replace the
     subtree at that point as a root by the expression generated using method
     :func:`expr`.
@@ -603,9 +621,13 @@ def mutUniform(individual, expr):
     :param individual: The tree to be mutated.
     :param expr: A function object that can generate an expression when
                  called.
+    :param rng: A :class:`random.Random` instance to draw from, the
+                :mod:`random` module when :obj:`None` (default).
     :returns: A tuple of one tree.
     """
-    index = random.randrange(len(individual))
+    if rng is None:
+        rng = random
+    index = rng.randrange(len(individual))
     slice_ = individual.searchSubtree(index)
     type_ = individual[index].ret
     individual[slice_] = expr(pset=individual.pset, type_=type_)
@@ -740,7 +762,7 @@ def mutShrink(individual):
 # GP bloat control decorators        #
 ######################################
 
-def staticDepthLimit(max_depth):
+def staticDepthLimit(max_depth, rng=None):
     """Implement a static limit on the depth of a GP tree, as defined by Koza
     in [Koza1989]. It may be used to decorate both crossover and mutation
     operators. When an invalid (too high) child is generated, it is simply
@@ -753,6 +775,8 @@ def staticDepthLimit(max_depth):
     time).
     
     :param max_depth: The maximum depth allowed for an individual.
+    :param rng: A :class:`random.Random` instance to draw from, the
+                :mod:`random` module when :obj:`None` (default).
     :returns: A decorator that can be applied to a GP operator using \
     :func:`~deap.base.Toolbox.decorate`
 
@@ -765,34 +789,40 @@ def staticDepthLimit(max_depth):
         Cambridge, MA, 1992)
 
     """
+    if rng is None:
+        rng = random
     def decorator(func):
         def wrapper(*args, **kwargs):
             keep_inds = [copy.deepcopy(ind) for ind in args]
             new_inds = list(func(*args, **kwargs))
             for i, ind in enumerate(new_inds):
                 if ind.height > max_depth:
-                    new_inds[i] = random.choice(keep_inds)
+                    new_inds[i] = rng.choice(keep_inds)
             return new_inds
         return wrapper
     return decorator
     
-def staticSizeLimit(max_size):
+def staticSizeLimit(max_size, rng=None):
     """Implement a static limit on the size of a GP tree. It may be used to
     decorate both crossover and mutation operators. When an invalid (too big)
     child is generated, it is simply replaced by one of its parents.
     
     :param max_size: The maximum size (number of nodes) allowed for an \
     individual
+    :param rng: A :class:`random.Random` instance to draw from, the
+                :mod:`random` module when :obj:`None` (default).
     :returns: A decorator that can be applied to a GP operator using \
     :func:`~deap.base.Toolbox.decorate`
     """
+    if rng is None:
+        rng = random
     def decorator(func):
         def wrapper(*args, **kwargs):
             keep_inds = [copy.deepcopy(ind) for ind in args]
             new_inds = list(func(*args, **kwargs))
             for i, ind in enumerate(new_inds):
                 if len(ind) > max_size:
-                    new_inds[i] = random.choice(keep_inds)
+                    new_inds[i] = rng.choice(keep_inds)
             return new_inds
         return wrapper
     return decorator
@@ -745,20 +745,24 @@ def cxTwoPoints(ind1, ind2):
         
     return ind1, ind2
 
-def cxOnePoint(ind1, ind2):
+def cxOnePoint(ind1, ind2, rng=None):
     """Execute a one point crossover on the input individuals.
     The two individuals are modified in place. The resulting individuals will
     respectively have the length of the other.
     
     :param ind1: The first individual participating in the crossover.
     :param ind2: The second individual participating in the crossover.
+    :param rng: A :class:`random.Random` instance to draw from, the
+                :mod:`random` module when :obj:`None` (default).
     :returns: A tuple of two individuals.
 
     This function use the :func:`~random.randint` function from the
     python base :mod:`random` module.
     """
+    if rng is None:
+        rng = random
     size = min(len(ind1), len(ind2))
-    cxpoint = random.randint(1, size - 1)
+    cxpoint = rng.randint(1, size - 1)
     ind1[cxpoint:], ind2[cxpoint:] = ind2[cxpoint:], ind1[cxpoint:]
     
     return ind1, ind2
@@ -1189,7 +1193,7 @@ def mutPolynomialBounded(individual, eta, low, up, indpb):
             individual[i] = x
     return individual,
 
-def mutShuffleIndexes(individual, indpb):
+def mutShuffleIndexes(individual, indpb, rng=None):
     """Shuffle the attributes of the input individual and return the mutant.
     The *individual* is expected to be iterable. The *indpb* argument is the
     probability of each attribute to be moved. Usually this mutation is applied on 
@@ -1198,15 +1202,19 @@ def mutShuffleIndexes(individual, indpb):
     :param individual: Individual to be mutated.
     :param indpb: Probability for each attribute to be exchanged to another
                   position.
+    :param rng: A :class:`random.Random` instance to draw from, the
+                :mod:`random` module when :obj:`None` (default).
     :returns: A tuple of one individual.
     
     This function uses the :func:`~random.random` and :func:`~random.randint`
     functions from the python base :mod:`random` module.
     """
+    if rng is None:
+        rng = random
     size = len(individual)
     for i in xrange(size):
-        if random.random() < indpb:
-            swap_indx = random.randint(0, size - 2)
+        if rng.random() < indpb:
+            swap_indx = rng.randint(0, size - 2)
             if swap_indx >= i:
                 swap_indx += 1
             individual[i], individual[swap_indx] = \
@@ -1298,19 +1306,23 @@ def mutESLogNormal(individual, c, indpb):
 # Selections                         #
 ######################################
 
-def selRandom(individuals, k):
+def selRandom(individuals, k, rng=None):
     """Select *k* individuals at random from the input *individuals* with
     replacement. The list returned contains references to the input
     *individuals*.
     
     :param individuals: A list of individuals to select from.
     :param k: The number of individuals to select.
+    :param rng: A :class:`random.Random` instance to draw from, the
+                :mod:`random` module when :obj:`None` (default).
     :returns: A list of selected individuals.
     
     This function uses the :func:`~random.choice` function from the
     python base :mod:`random` module.
     """
-    return [random.choice(individuals) for i in xrange(k)]
+    if rng is None:
+        rng = random
+    return [rng.choice(individuals) for i in xrange(k)]
 
 
 def selBest(individuals, k):
@@ -1335,7 +1347,7 @@ def selWorst(individuals, k):
     return sorted(individuals, key=attrgetter("fitness"))[:k]
 
 
-def selTournament(individuals, k, tournsize):
+def selTournament(individuals, k, tournsize, rng=None):
     """Select *k* individuals from the input *individuals* using *k*
     tournaments of *tournsize* individuals. The list returned contains
     references to the input *individuals*.
@@ -1343,6 +1355,8 @@ def selTournament(individuals, k, tournsize):
     :param individuals: A list of individuals to select from.
     :param k: The number of individuals to select.
     :param tournsize: The number of individuals participating in each tournament.
+    :param rng: A :class:`random.Random` instance to draw from, the
+                :mod:`random` module when :obj:`None` (default).
     :returns: A list of selected individuals.
     
     This function uses the :func:`~random.choice` function from the python base
@@ -1350,7 +1364,7 @@ def selTournament(individuals, k, tournsize):
     """
     chosen = []
     for i in xrange(k):
-        aspirants = selRandom(individuals, tournsize)
+        aspirants = selRandom(individuals, tournsize, rng)
         chosen.append(max(aspirants, key=attrgetter("fitness")))
     return chosen
 
@@ -1431,7 +1445,7 @@ def selTournamentDCD(individuals, k):
     return chosen
     
 
-def selDoubleTournament(individuals, k, fitness_size, parsimony_size, fitness_first):
+def selDoubleTournament(individuals, k, fitness_size, parsimony_size, fitness_first, rng=None):
     """Tournament selection which use the size of the individuals in order
     to discriminate good solutions. This kind of tournament is obviously
     useless with fixed-length representation, but has been shown to
@@ -1466,12 +1480,16 @@ def selDoubleTournament(individuals, k, fitness_size, parsimony_size, fitness_fi
     (size tournament feeding fitness tournaments with candidates). It has been \
     shown that this parameter does not have a significant effect in most cases\
     (see [Luke2002fighting]_).
+    :param rng: A :class:`random.Random` instance to draw from, the
+                :mod:`random` module when :obj:`None` (default).
     :returns: A list of selected individuals.
     
     .. [Luke2002fighting] Luke and Panait, 2002, Fighting bloat with 
         nonparametric parsimony pressure
     """
     assert (1 <= parsimony_size <= 2), "Parsimony tournament size has to be in the range [1, 2]."
+    if rng is None:
+        rng = random
 
     def _sizeTournament(individuals, k, select):
         chosen = []
@@ -1489,7 +1507,7 @@ def selDoubleTournament(individuals, k, fitness_size, parsimony_size, fitness_fi
 
             # Since size1 <= size2 then ind1 is selected
             # with a probability prob
-            chosen.append(ind1 if random.random() < prob else ind2)
+            chosen.append(ind1 if rng.random() < prob else ind2)
 
         return chosen
     
@@ -1500,11 +1518,12 @@ def selDoubleTournament(individuals, k, fitness_size, parsimony_size, fitness_fi
             chosen.append(max(aspirants, key=attrgetter("fitness")))
         return chosen
     
+    select = partial(selRandom, rng=rng)
     if fitness_first:
-        tfit = partial(_fitTournament, select=selRandom)
+        tfit = partial(_fitTournament, select=select)
         return _sizeTournament(individuals, k, tfit)
     else:
-        tsize = partial(_sizeTournament, select=selRandom)
+        tsize = partial(_sizeTournament, select=select)
         return _fitTournament(individuals, k, tsize)
 
 ######################################
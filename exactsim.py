@@ -0,0 +1,259 @@
+"""Exact outcome distribution of an action sequence.
+
+Follows the same rules as main.MonteCarloSynth, but instead of drawing random
+conditions and successes it carries the probability of every reachable state
+from step to step. States that are reached in more than one way are merged.
+Quality never affects how later steps play out, so each frontier entry holds
+the distribution of quality for one state of everything else.
+"""
+
+from collections import defaultdict
+
+import main
+
+
+# Condition codes
+NORMAL = 0
+GOOD = 1
+EXCELLENT = 2
+POOR = 3
+
+
+class SynthDistribution(object):
+    """Exact distribution of the final quality of a sequence.
+
+    :ivar qualityDistribution: List of (quality, probability) pairs sorted by quality.
+    :ivar failureProbability: Probability that any of the progress, durability,
+                              CP or tricks checks fail.
+    :ivar expectedQuality: Mean of the final quality.
+    :ivar minQuality: Smallest final quality with a non-zero probability.
+    :ivar hqPercent: Expected HQ chance in percent.
+    :ivar peakStates: Largest number of distinct states held in one step.
+    """
+    def __init__(self, qualityDistribution, failureProbability, expectedQuality, minQuality, hqPercent, peakStates):
+        self.qualityDistribution = qualityDistribution
+        self.failureProbability = failureProbability
+        self.expectedQuality = expectedQuality
+        self.minQuality = minQuality
+        self.hqPercent = hqPercent
+        self.peakStates = peakStates
+
+
+class TooManyStatesError(ValueError):
+    """Raised when the frontier of :func:`exactSynth` outgrows its limit."""
+    pass
+
+
+def bucketDistribution(qualityDistribution, bucketSize):
+    """Merge a quality distribution into buckets of *bucketSize* quality.
+
+    :returns: A list of (quality, probability) pairs sorted by quality, where
+              quality is the lower end of each bucket that has a non-zero
+              probability.
+    """
+    buckets = defaultdict(float)
+    for quality, p in qualityDistribution:
+        buckets[int(quality // bucketSize) * bucketSize] += p
+    return sorted(buckets.items())
+
+
+def _conditionOutcomes(condition):
+    """Conditions of the next step and their probabilities."""
+    pGood = 0.23
+    pExcellent = 0.01
+
+    if condition == EXCELLENT:
+        return ((POOR, 1.0),)
+    elif condition == GOOD or condition == POOR:
+        return ((NORMAL, 1.0),)
+    return ((EXCELLENT, pExcellent), (GOOD, pGood), (NORMAL, 1 - pExcellent - pGood))
+
+
+def _successProbability(action, countDowns):
+    if countDowns[main.steadyHand2.effectSlot]:
+        successProbability = action.successProbability + 0.3
+    elif countDowns[main.steadyHand.effectSlot]:
+        successProbability = action.successProbability + 0.2
+    else:
+        successProbability = action.successProbability
+    return min(successProbability, 1)
+
+
+def _step(synth, state, action, condition, success):
+    """Apply one action to a state for a known condition and success outcome.
+
+    :returns: The next state and the quality gained.
+    """
+    _, durabilityState, cpState, progressState, trickUses, iqStacks, countDowns = state
+    countDowns = list(countDowns)
+
+    # Add effect modifiers
+    gainTables = synth.gainTables()
+    levelDifference = synth.crafter.level - synth.recipe.level
+    if countDowns[main.ingenuity2.effectSlot]:
+        levelDifference = 3
+    elif countDowns[main.ingenuity.effectSlot]:
+        levelDifference = 0
+
+    qualityIncreaseMultiplier = action.qualityIncreaseMultiplier
+    if countDowns[main.greatStrides.effectSlot]:
+        qualityIncreaseMultiplier *= 2
+
+    # Condition Calculation
+    if condition == POOR:
+        qualityIncreaseMultiplier *= 0.5
+    elif condition == EXCELLENT:
+        qualityIncreaseMultiplier *= 4
+    elif condition == GOOD:
+        if trickUses < synth.maxTrickUses:
+            # Assumes first N good actions will always be used for ToT
+            trickUses += 1
+            cpState += 20
+        else:
+            qualityIncreaseMultiplier *= 1.5
+
+    # Calculate final gains / losses
+    bProgressGain = action.progressIncreaseMultiplier * gainTables.progress[levelDifference]
+    if action.id == main.flawlessSynthesis.id:
+        bProgressGain = 40
+    elif action.id == main.pieceByPiece.id:
+        bProgressGain = (synth.recipe.difficulty - progressState)/3
+    progressGain = success * bProgressGain
+
+    bQualityGain = qualityIncreaseMultiplier * gainTables.baseQuality(levelDifference, iqStacks, countDowns[main.innovation.effectSlot] > 0)
+    qualityGain = success * bQualityGain
+    if action.id == main.byregotsBlessing.id and iqStacks is not None:
+        qualityGain *= (1 + 0.2 * iqStacks)
+
+    durabilityCost = action.durabilityCost
+    if countDowns[main.wasteNot.effectSlot] or countDowns[main.wasteNot2.effectSlot]:
+        durabilityCost = 0.5 * action.durabilityCost
+
+    # Wasted actions change nothing that matters for the outcome
+    if (progressState >= synth.recipe.difficulty or durabilityState <= 0) and action.id != main.dummyAction.id:
+        qualityGain = 0
+    else:
+        # State tracking
+        progressState += progressGain
+        durabilityState -= durabilityCost
+        cpState -= action.cpCost
+
+        # Effect management
+        if action.id == main.mastersMend.id:
+            durabilityState += 30
+
+        if action.id == main.mastersMend2.id:
+            durabilityState += 60
+
+        if countDowns[main.manipulation.effectSlot] and durabilityState > 0:
+            durabilityState += 10
+
+        if countDowns[main.comfortZone.effectSlot] and cpState > 0:
+            cpState += 8
+
+        if action.id == main.rumination.id and cpState > 0:
+            if iqStacks is not None and iqStacks > 0:
+                cpState += (21 * iqStacks - iqStacks**2 + 10)/2
+                iqStacks = None
+
+        if action.id == main.byregotsBlessing.id:
+            iqStacks = None
+
+        if action.qualityIncreaseMultiplier > 0:
+            countDowns[main.greatStrides.effectSlot] = 0
+
+        # Decrement countdowns
+        for slot in range(main.nEffectSlots):
+            if countDowns[slot]:
+                countDowns[slot] -= 1
+
+        # Increment countups
+        if action.qualityIncreaseMultiplier > 0 and iqStacks is not None:
+            iqStacks += 1 * success
+
+        # Initialize new effects after countdowns are managed to reset them properly
+        # Inner Quiet is the only countup effect
+        if action.type == "countup":
+            iqStacks = 0
+
+        if action.type == "countdown":
+            countDowns[action.effectSlot] = action.activeTurns
+
+        # Sanity checks for state variables
+        durabilityState = min(durabilityState, synth.recipe.durability)
+        cpState = min(cpState, synth.crafter.craftPoints)
+
+    nextState = (condition, durabilityState, cpState, progressState, trickUses, iqStacks, tuple(countDowns))
+    return nextState, qualityGain
+
+
+def exactSynth(individual, synth, qualityResolution=None, maxStates=None):
+    """Compute the exact distribution of the outcome of a sequence.
+
+    :param individual: Sequence of Actions.
+    :param synth: The Synth to simulate.
+    :param qualityResolution: If given, quality values are rounded to this
+                              resolution so that nearly equal outcomes are
+                              merged, which bounds the size of the
+                              distribution for long sequences.
+    :param maxStates: If given, the most distinct states a step may reach.
+                      The frontier can grow exponentially with the number of
+                      condition and success branches, so callers that must
+                      answer quickly should set it.
+    :raises TooManyStatesError: If a step reaches more than *maxStates* states.
+    :returns: A :class:`SynthDistribution`.
+    """
+    # Strip Tricks of the Trade
+    individual = [x for x in individual if x.id != main.tricksOfTheTrade.id]
+
+    startQuality = synth.recipe.startQuality
+    if not individual:
+        return SynthDistribution([(startQuality, 1.0)], 1.0, startQuality, startQuality,
+                                 main.hqPercentFromQuality(float(startQuality) / synth.recipe.maxQuality * 100), 1)
+
+    # The condition before step 1 is normal, step 1 draws its own like MonteCarloSynth
+    startState = (NORMAL, synth.recipe.durability, synth.crafter.craftPoints, 0, 0, None, main.nEffectSlots * (0,))
+    frontier = {startState: {startQuality: 1.0}}
+    peakStates = 1
+
+    for action in individual:
+        nextFrontier = defaultdict(lambda: defaultdict(float))
+        for state, qualities in frontier.items():
+            successProbability = _successProbability(action, state[6])
+            for condition, pCondition in _conditionOutcomes(state[0]):
+                for success, pSuccess in ((1, successProbability), (0, 1 - successProbability)):
+                    if pSuccess <= 0:
+                        continue
+                    nextState, qualityGain = _step(synth, state, action, condition, success)
+                    p = pCondition * pSuccess
+                    nextQualities = nextFrontier[nextState]
+                    for quality, pQuality in qualities.items():
+                        quality += qualityGain
+                        if qualityResolution:
+                            quality = round(quality / qualityResolution) * qualityResolution
+                        nextQualities[quality] += p * pQuality
+            if maxStates is not None and len(nextFrontier) > maxStates:
+                raise TooManyStatesError("Exact simulation reached more than %i states" % maxStates)
+        frontier = nextFrontier
+        peakStates = max(peakStates, len(frontier))
+
+    # Penalise failure outcomes
+    qualityDistribution = defaultdict(float)
+    failureProbability = 0.0
+    for state, qualities in frontier.items():
+        _, durabilityState, cpState, progressState, trickUses, _, _ = state
+        progressOk = progressState >= synth.recipe.difficulty
+        cpOk = cpState >= 0
+        durabilityOk = durabilityState >= 0 and progressOk
+        trickOk = trickUses <= synth.maxTrickUses
+        for quality, p in qualities.items():
+            qualityDistribution[quality] += p
+            if not (progressOk and cpOk and durabilityOk and trickOk):
+                failureProbability += p
+
+    qualityDistribution = sorted(qualityDistribution.items())
+    expectedQuality = sum(q * p for q, p in qualityDistribution)
+    minQuality = qualityDistribution[0][0]
+    hqPercent = sum(p * main.hqPercentFromQuality(float(q) / synth.recipe.maxQuality * 100) for q, p in qualityDistribution)
+
+    return SynthDistribution(qualityDistribution, failureProbability, expectedQuality, minQuality, hqPercent, peakStates)
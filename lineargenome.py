@@ -0,0 +1,89 @@
+"""Initialization and variation operators for linear genomes.
+
+A linear genome is a flat, variable length array of Action ids, as opposed to
+the binary trees of prog2 primitives used by mainGP by default. It needs no
+flattening before evaluation and is cheap to copy. Every operator takes the
+random number generator to draw from as *rng*, the :mod:`random` module when
+None, and modifies the individuals in place like the DEAP operators do.
+"""
+
+import random
+
+
+def initLinear(container, genes, minLength, maxLength, rng=None):
+    """Create a genome of random genes with a random length between
+    minLength and maxLength inclusive."""
+    if rng is None:
+        rng = random
+    return container([rng.choice(genes) for i in range(rng.randint(minLength, maxLength))])
+
+
+def mutInsert(individual, genes, maxLength, rng=None):
+    """Insert a random gene at a random position."""
+    if rng is None:
+        rng = random
+    if len(individual) < maxLength:
+        individual.insert(rng.randint(0, len(individual)), rng.choice(genes))
+    return individual,
+
+
+def mutDelete(individual, minLength, rng=None):
+    """Delete the gene at a random position."""
+    if rng is None:
+        rng = random
+    if len(individual) > minLength:
+        del individual[rng.randrange(len(individual))]
+    return individual,
+
+
+def mutSwap(individual, rng=None):
+    """Swap the genes at two random positions."""
+    if rng is None:
+        rng = random
+    if len(individual) > 1:
+        i, j = rng.sample(range(len(individual)), 2)
+        individual[i], individual[j] = individual[j], individual[i]
+    return individual,
+
+
+def mutReplace(individual, genes, rng=None):
+    """Replace the gene at a random position by a random gene."""
+    if rng is None:
+        rng = random
+    if len(individual) > 0:
+        individual[rng.randrange(len(individual))] = rng.choice(genes)
+    return individual,
+
+
+def mutLinear(individual, genes, minLength, maxLength, rng=None):
+    """Apply one of the insert, delete, swap and replace mutations, chosen
+    with equal probability."""
+    if rng is None:
+        rng = random
+    choice = rng.randrange(4)
+    if choice == 0:
+        return mutInsert(individual, genes, maxLength, rng)
+    elif choice == 1:
+        return mutDelete(individual, minLength, rng)
+    elif choice == 2:
+        return mutSwap(individual, rng)
+    return mutReplace(individual, genes, rng)
+
+
+def cxSegment(ind1, ind2, minLength, maxLength, rng=None):
+    """Exchange a random segment of each individual, two cut points per
+    individual. The segments may differ in length so the lengths of the
+    children can change; if either child would fall outside of minLength
+    and maxLength the individuals are left unchanged.
+    """
+    if rng is None:
+        rng = random
+    start1, end1 = sorted((rng.randint(0, len(ind1)), rng.randint(0, len(ind1))))
+    start2, end2 = sorted((rng.randint(0, len(ind2)), rng.randint(0, len(ind2))))
+
+    length1 = len(ind1) - (end1 - start1) + (end2 - start2)
+    length2 = len(ind2) - (end2 - start2) + (end1 - start1)
+    if minLength <= length1 <= maxLength and minLength <= length2 <= maxLength:
+        ind1[start1:end1], ind2[start2:end2] = ind2[start2:end2], ind1[start1:end1]
+
+    return ind1, ind2
@@ -7,7 +7,8 @@
 # UI
 
 from __future__ import print_function
-import random, math, sys
+import random, math, sys, bisect, threading, array, traceback, StringIO, time, itertools
+from collections import namedtuple, OrderedDict
 from functools import partial
 
 from deap import algorithms
@@ -16,6 +17,10 @@ from deap import creator
 from deap import tools
 from deap import gp
 
+from simcache import PrefixStateCache, FitnessCache
+import mcstats
+import lineargenome
+
 # ==== Logging
 
 class Logger(object):
@@ -87,6 +92,42 @@ class Recipe:
         self.startQuality = startQuality
         self.maxQuality = maxQuality
 
+class GainTables:
+    """Lookup tables of the base progress and quality increases of a Synth.
+
+    progress maps the level differences a step can have, the crafter's own
+    and those set by Ingenuity and Ingenuity II, to the base progress
+    increase. quality maps (levelDifference, iqStacks, innovation) keys to
+    the base quality increase, where iqStacks is None without Inner Quiet.
+    It is filled as keys are first looked up. Increases for fractional IQ
+    stacks, as tracked by the expected value simulation, are computed but
+    not stored.
+    """
+    def __init__(self, synth, key):
+        self.synth = synth
+        self.key = key
+        self.control = synth.crafter.control
+
+        levelDifference = synth.crafter.level - synth.recipe.level
+        self.progress = {}
+        for ld in (levelDifference, 0, 3):
+            self.progress[ld] = synth.CalculateBaseProgressIncrease(ld, synth.crafter.craftsmanship)
+        self.quality = {}
+
+    def baseQuality(self, levelDifference, iqStacks, innovation):
+        key = (levelDifference, iqStacks, innovation)
+        baseQuality = self.quality.get(key)
+        if baseQuality is None:
+            control = self.control
+            if iqStacks is not None:
+                control *= (1 + 0.2 * iqStacks)
+            if innovation:
+                control *= 1.5
+            baseQuality = self.synth.CalculateBaseQualityIncrease(levelDifference, control)
+            if iqStacks is None or iqStacks == int(iqStacks):
+                self.quality[key] = baseQuality
+        return baseQuality
+
 #noinspection PyMethodMayBeStatic
 class Synth:
     def __init__(self, crafter, recipe, maxTrickUses=0, useConditions=False):
@@ -94,6 +135,15 @@ class Synth:
         self.recipe = recipe
         self.maxTrickUses = maxTrickUses
         self.useConditions = useConditions
+        self._gainTables = None
+
+    def gainTables(self):
+        """:class:`GainTables` of this synth, rebuilt when the crafter or
+        recipe stats they depend on have changed."""
+        key = (self.crafter.level, self.crafter.craftsmanship, self.crafter.control, self.recipe.level)
+        if self._gainTables is None or self._gainTables.key != key:
+            self._gainTables = GainTables(self, key)
+        return self._gainTables
 
     def CalculateBaseProgressIncrease(self, levelDifference, craftsmanship):
         if -5 <= levelDifference <= 0:
@@ -135,6 +185,8 @@ class Action:
             self.activeTurns = activeTurns      # Save some space
         self.cls = cls
         self.level = level
+        self.id = -1                # Assigned by compileActionTable
+        self.effectSlot = -1        # Assigned by compileActionTable for countup/countdown actions
 
     def __eq__(self, other):
         if self.name == other.name:
@@ -154,11 +206,63 @@ class Action:
     def __str__(self):
         return self.shortName
 
+class MonteCarloResult:
+    """Summary of a Monte Carlo simulation.
+
+    durability, cp, quality, progress and hq are
+    :class:`~mcstats.RunningStats` of the final states of the runs, where hq
+    holds the HQ% of each run. converged tells whether an adaptive simulation
+    reached its target precision and is None otherwise.
+    """
+    def __init__(self, durability, cp, quality, progress, hq, minHqPercent, percentiles=None, confidence=None, converged=None):
+        self.nRuns = quality.n
+        self.durability = durability
+        self.cp = cp
+        self.quality = quality
+        self.progress = progress
+        self.hq = hq
+        self.hqPercent = hq.mean
+        self.minHqPercent = minHqPercent
+        self.percentiles = percentiles
+        self.confidence = confidence
+        self.converged = converged
+
+    def toDict(self):
+        result = {
+            "nRuns": self.nRuns,
+            "durability": self.durability.toDict(),
+            "cp": self.cp.toDict(),
+            "quality": self.quality.toDict(),
+            "progress": self.progress.toDict(),
+            "hqPercent": self.hqPercent,
+            "hqPercentStdError": self.hq.stdError(),
+            "minHqPercent": self.minHqPercent,
+        }
+
+        if self.percentiles:
+            result["hqPercentiles"] = [[p, self.hq.quantile(p)] for p in self.percentiles]
+            result["qualityPercentiles"] = [[p, self.quality.quantile(p)] for p in self.percentiles]
+
+        if self.confidence:
+            result["hqPercentCI"] = list(self.hq.confidenceInterval(self.confidence))
+
+        if self.converged is not None:
+            result["converged"] = self.converged
+
+        return result
+
 class EffectTracker:
+    """Array-backed effect state indexed by Action.effectSlot.
+
+    countUps holds the stack count of an active countup effect or None if it is
+    inactive, countDowns holds the remaining turns of a countdown effect or 0 if
+    it is inactive.
+    """
+    __slots__ = ("countUps", "countDowns")
+
     def __init__(self):
-        self.countUps = {}
-        self.countDowns = {}
-        self.toggles = {}
+        self.countUps = nEffectSlots * [None]
+        self.countDowns = nEffectSlots * [0]
 
 class State:
     def __init__(self, step=0, action="", durabilityState=0, cpState=0, qualityState=0, progressState=0, wastedActions=0, progressOk=False, cpOk=False, durabilityOk=False, trickOk=False, crossClassActionList=None):
@@ -179,7 +283,25 @@ class State:
             self.crossClassActionList = crossClassActionList
 
 # Probabalistic Simulation Function
-def simSynth(individual, synth, verbose=True, debug=False, logOutput=None):
+# State of the expected value simulation of simFitness. Effects are given by
+# the liveSteps value at which they expire and the condition by the
+# probability of each condition at the next step.
+FitnessState = namedtuple("FitnessState", ["durabilityState", "cpState", "qualityState", "progressState", "wastedActions", "trickUses",
+                                           "iqStacks", "expiry", "liveSteps", "crossClassIds", "finishStep",
+                                           "ppGood", "ppExcellent", "ppPoor", "ppNormal"])
+
+def simSynth(individual, synth, verbose=True, debug=False, logOutput=None, cache=None, startState=None):
+    """Expected value simulation of a sequence of Actions.
+
+    If a :class:`~simcache.PrefixStateCache` for the synth is given as *cache*,
+    the simulation resumes from the longest cached prefix of the sequence and
+    caches the state after every step it simulates. The cache is not used when
+    logging.
+
+    Given a :class:`FitnessState` as *startState*, for example from
+    :func:`liveFitnessState`, the simulation continues from it instead of the
+    start of the synth. Steps are numbered from that state on.
+    """
     logger = Logger(logOutput)
 
     # State tracking
@@ -190,8 +312,22 @@ def simSynth(individual, synth, verbose=True, debug=False, logOutput=None):
     stepCount = 0
     wastedActions = 0
     effects = EffectTracker()
+    countUps = effects.countUps
+    countDowns = effects.countDowns
+    iqSlot = innerQuiet.effectSlot
+    innovationSlot = innovation.effectSlot
+    ingenuitySlot = ingenuity.effectSlot
+    ingenuity2Slot = ingenuity2.effectSlot
+    steadyHandSlot = steadyHand.effectSlot
+    steadyHand2Slot = steadyHand2.effectSlot
+    greatStridesSlot = greatStrides.effectSlot
+    wasteNotSlot = wasteNot.effectSlot
+    wasteNot2Slot = wasteNot2.effectSlot
+    manipulationSlot = manipulation.effectSlot
+    comfortZoneSlot = comfortZone.effectSlot
     trickUses = 0
     crossClassActionList = []
+    gainTables = synth.gainTables()
 
     # Conditions
     pGood = 0.23
@@ -210,7 +346,18 @@ def simSynth(individual, synth, verbose=True, debug=False, logOutput=None):
     durabilityOk = False
     trickOk = False
 
-    if not individual:
+    if startState is not None:
+        if cache is not None:
+            raise ValueError("A state cache cannot be used with a start state")
+        durabilityState, cpState, qualityState, progressState = startState[:4]
+        wastedActions = startState.wastedActions
+        trickUses = startState.trickUses
+        countUps[iqSlot] = startState.iqStacks
+        countDowns[:] = [max(expiry - startState.liveSteps, 0) for expiry in startState.expiry]
+        crossClassActionList[:] = [actionTable[actionId] for actionId in sorted(startState.crossClassIds)]
+        ppGood, ppExcellent, ppPoor, ppNormal = startState.ppGood, startState.ppExcellent, startState.ppPoor, startState.ppNormal
+
+    if not individual and startState is None:
         return State(stepCount, "", durabilityState, cpState, qualityState, progressState,
                            wastedActions, progressOk, cpOk, durabilityOk, trickOk, crossClassActionList)
 
@@ -222,36 +369,45 @@ def simSynth(individual, synth, verbose=True, debug=False, logOutput=None):
         logger.log("%2s %-20s %5s %5s %8s %5s %5s %5s %5s %5s %5s %5s" % ("#", "Action", "DUR", "CP", "EQUA", "EPRG", "WAC", "IQ", "CTL", "QINC", "BPRG", "BQUA"))
         logger.log("%2i %-20s %5i %5i %8.1f %5.1f %5i %5.1f %5i %5i" % (stepCount, "", durabilityState, cpState, qualityState, progressState, wastedActions, 0, synth.crafter.control, 0))
 
-    for action in individual:
+    # Resume from the longest cached prefix
+    cacheNode = None
+    if cache is not None and not (verbose or debug):
+        if cache.synth is not synth:
+            raise ValueError("State cache was created for a different synth")
+        cacheNode, stepCount, snapshot = cache.lookup([action.id for action in individual])
+        if snapshot is not None:
+            (durabilityState, cpState, qualityState, progressState, wastedActions, trickUses, countUps[:], countDowns[:],
+             crossClassActionList[:], ppGood, ppExcellent, ppPoor, ppNormal) = snapshot
+
+    for action in individual[stepCount:]:
         # Occur regardless of dummy actions
         #==================================
         stepCount += 1
 
         # Add effect modifiers
-        craftsmanship = synth.crafter.craftsmanship
         control = synth.crafter.control
-        if innerQuiet.name in effects.countUps:
-            control *= (1 + 0.2 * effects.countUps[innerQuiet.name])
+        if countUps[iqSlot] is not None:
+            control *= (1 + 0.2 * countUps[iqSlot])
 
-        if innovation.name in effects.countDowns:
+        if countDowns[innovationSlot]:
             control *= 1.5
 
         levelDifference = synth.crafter.level - synth.recipe.level
-        if ingenuity2.name in effects.countDowns:
+        if countDowns[ingenuity2Slot]:
             levelDifference = 3
-        elif ingenuity.name in effects.countDowns:
+        elif countDowns[ingenuitySlot]:
             levelDifference = 0
 
-        if steadyHand2.name in effects.countDowns:
+        if countDowns[steadyHand2Slot]:
             successProbability = action.successProbability + 0.3        # What is effect of having both active? Assume 2 always overrides 1 but does not overwrite
-        elif steadyHand.name in effects.countDowns:
+        elif countDowns[steadyHandSlot]:
             successProbability = action.successProbability + 0.2
         else:
             successProbability = action.successProbability
         successProbability = min(successProbability, 1)
 
         qualityIncreaseMultiplier = action.qualityIncreaseMultiplier
-        if greatStrides.name in effects.countDowns:
+        if countDowns[greatStridesSlot]:
             qualityIncreaseMultiplier *= 2
 
         # Condition Calculation
@@ -259,25 +415,25 @@ def simSynth(individual, synth, verbose=True, debug=False, logOutput=None):
             qualityIncreaseMultiplier *= (1*ppNormal + 1.5*ppGood + 4*ppExcellent + 0.5*ppPoor)
 
         # Calculate final gains / losses
-        bProgressGain = action.progressIncreaseMultiplier * synth.CalculateBaseProgressIncrease(levelDifference, craftsmanship)
-        if action == flawlessSynthesis:
+        bProgressGain = action.progressIncreaseMultiplier * gainTables.progress[levelDifference]
+        if action.id == flawlessSynthesis.id:
             bProgressGain = 40
-        elif action == pieceByPiece:
+        elif action.id == pieceByPiece.id:
             bProgressGain = (synth.recipe.difficulty - progressState)/3
         progressGain = successProbability * bProgressGain
 
-        bQualityGain = qualityIncreaseMultiplier * synth.CalculateBaseQualityIncrease(levelDifference, control)
+        bQualityGain = qualityIncreaseMultiplier * gainTables.baseQuality(levelDifference, countUps[iqSlot], countDowns[innovationSlot] > 0)
         qualityGain = successProbability * bQualityGain
-        if action == byregotsBlessing and innerQuiet.name in effects.countUps:
-            qualityGain *= (1 + 0.2 * effects.countUps[innerQuiet.name])
+        if action.id == byregotsBlessing.id and countUps[iqSlot] is not None:
+            qualityGain *= (1 + 0.2 * countUps[iqSlot])
 
         durabilityCost = action.durabilityCost
-        if wasteNot.name in effects.countDowns or wasteNot2.name in effects.countDowns:
+        if countDowns[wasteNotSlot] or countDowns[wasteNot2Slot]:
             durabilityCost = 0.5 * action.durabilityCost
 
         # Occur if a dummy action
         #==================================
-        if (progressState >= synth.recipe.difficulty or durabilityState <= 0) and action != dummyAction:
+        if (progressState >= synth.recipe.difficulty or durabilityState <= 0) and action.id != dummyAction.id:
             wastedActions += 1
 
         # Occur if not a dummy action
@@ -292,35 +448,35 @@ def simSynth(individual, synth, verbose=True, debug=False, logOutput=None):
             # Effect management
             #==================================
             # Special Effect Actions
-            if action == mastersMend:
+            if action.id == mastersMend.id:
                 durabilityState += 30
 
-            if action == mastersMend2:
+            if action.id == mastersMend2.id:
                 durabilityState += 60
 
-            if manipulation.name in effects.countDowns and durabilityState > 0:
+            if countDowns[manipulationSlot] and durabilityState > 0:
                 durabilityState += 10
 
-            if comfortZone.name in effects.countDowns and cpState > 0:
+            if countDowns[comfortZoneSlot] and cpState > 0:
                 cpState += 8
 
-            if action == rumination and cpState > 0:
-                if innerQuiet.name in effects.countUps and effects.countUps[innerQuiet.name] > 0:
-                    cpState += (21 * effects.countUps[innerQuiet.name] - effects.countUps[innerQuiet.name]**2 + 10)/2
-                    del effects.countUps[innerQuiet.name]
+            if action.id == rumination.id and cpState > 0:
+                if countUps[iqSlot] is not None and countUps[iqSlot] > 0:
+                    cpState += (21 * countUps[iqSlot] - countUps[iqSlot]**2 + 10)/2
+                    countUps[iqSlot] = None
                 else:
                     wastedActions += 1
 
-            if action == byregotsBlessing:
-                if innerQuiet.name in effects.countUps:
-                    del effects.countUps[innerQuiet.name]
+            if action.id == byregotsBlessing.id:
+                if countUps[iqSlot] is not None:
+                    countUps[iqSlot] = None
                 else:
                     wastedActions += 1
 
-            if action.qualityIncreaseMultiplier > 0 and greatStrides.name in effects.countDowns:
-                del effects.countDowns[greatStrides.name]
+            if action.qualityIncreaseMultiplier > 0 and countDowns[greatStridesSlot]:
+                countDowns[greatStridesSlot] = 0
 
-            if action == tricksOfTheTrade and cpState > 0:
+            if action.id == tricksOfTheTrade.id and cpState > 0:
                 trickUses += 1
                 cpState += 20
 
@@ -332,21 +488,20 @@ def simSynth(individual, synth, verbose=True, debug=False, logOutput=None):
                 ppNormal = 1 - (ppGood + ppExcellent + ppPoor)
 
             # Decrement countdowns
-            for countDown in list(effects.countDowns.keys()):
-                effects.countDowns[countDown] -= 1
-                if effects.countDowns[countDown] == 0:
-                    del effects.countDowns[countDown]
+            for slot in range(nEffectSlots):
+                if countDowns[slot]:
+                    countDowns[slot] -= 1
 
             # Increment countups
-            if action.qualityIncreaseMultiplier > 0 and innerQuiet.name in effects.countUps:
-                effects.countUps[innerQuiet.name] += 1 * successProbability
+            if action.qualityIncreaseMultiplier > 0 and countUps[iqSlot] is not None:
+                countUps[iqSlot] += 1 * successProbability
 
             # Initialize new effects after countdowns are managed to reset them properly
             if action.type == "countup":
-                effects.countUps[action.name] = 0
+                countUps[action.effectSlot] = 0
 
             if action.type == "countdown":
-                effects.countDowns[action.name] = action.activeTurns
+                countDowns[action.effectSlot] = action.activeTurns
 
             # Sanity checks for state variables
             durabilityState = min(durabilityState, synth.recipe.durability)
@@ -361,10 +516,14 @@ def simSynth(individual, synth, verbose=True, debug=False, logOutput=None):
 
         if debug:
             iqCnt = 0
-            if innerQuiet.name in effects.countUps:
-                iqCnt = effects.countUps[innerQuiet.name]
+            if countUps[iqSlot] is not None:
+                iqCnt = countUps[iqSlot]
             logger.log("%2i %-20s %5i %5i %8.1f %5.1f %5i %5.1f %5i %5i %5i %5i" % (stepCount, action.name, durabilityState, cpState, qualityState, progressState, wastedActions, iqCnt, control, qualityGain, bProgressGain, bQualityGain))
 
+        if cacheNode is not None:
+            cacheNode = cache.extend(cacheNode, action.id, (durabilityState, cpState, qualityState, progressState, wastedActions, trickUses, tuple(countUps), tuple(countDowns),
+                                                            tuple(crossClassActionList), ppGood, ppExcellent, ppPoor, ppNormal))
+
     # Penalise failure outcomes
     if progressState >= synth.recipe.difficulty:
         progressOk = True
@@ -378,7 +537,7 @@ def simSynth(individual, synth, verbose=True, debug=False, logOutput=None):
     if trickUses <= synth.maxTrickUses:
         trickOk = True
 
-    finalState = State(stepCount, individual[-1].name, durabilityState, cpState, qualityState, progressState,
+    finalState = State(stepCount, individual[-1].name if individual else "", durabilityState, cpState, qualityState, progressState,
                        wastedActions, progressOk, cpOk, durabilityOk, trickOk, crossClassActionList)
 
     if verbose:
@@ -389,8 +548,320 @@ def simSynth(individual, synth, verbose=True, debug=False, logOutput=None):
 
     return finalState
 
+# Fitness Evaluation Function
+def simFitness(individual, synth, cache=None, reportFinish=False, startState=None, reportState=False):
+    """Expected value simulation of a sequence of Actions for fitness evaluation.
+
+    Follows the same rules as :func:`simSynth` but without logging or
+    building a :class:`State`. Effects are tracked by the number of steps
+    after which they expire, so no countdowns need to be decremented.
+
+    If a :class:`~simcache.PrefixStateCache` for the synth is given as *cache*,
+    the simulation resumes from the longest cached prefix of the sequence.
+    Its snapshots differ from those of :func:`simSynth`, so a cache must not
+    be shared between the two.
+
+    Given a :class:`FitnessState` as *startState* the simulation continues
+    from it instead of the start of the synth. Such a state is reported as
+    the last element of the result with *reportState*, so a sequence can be
+    simulated step by step.
+
+    :returns: A (quality, progress, penalties, crossClassCount) tuple where
+              penalties counts the wasted actions and the failed durability,
+              progress, CP and tricks checks. With *reportFinish* a fifth
+              element gives the number of actions before the first one that
+              was wasted because the synth was finished, or None.
+    """
+    recipe = synth.recipe
+    crafter = synth.crafter
+    difficulty = recipe.difficulty
+    maxDurability = recipe.durability
+    maxCp = crafter.craftPoints
+    crafterCls = crafter.cls
+    useConditions = synth.useConditions
+
+    # State tracking
+    durabilityState = maxDurability
+    cpState = maxCp
+    progressState = 0
+    qualityState = recipe.startQuality
+    wastedActions = 0
+    trickUses = 0
+    iqStacks = None
+    expiry = nEffectSlots * [0]
+    liveSteps = 0
+    crossClassIds = set()
+    finishStep = None
+
+    if not individual and startState is None:
+        if reportFinish:
+            return qualityState, progressState, 4, 0, finishStep
+        return qualityState, progressState, 4, 0
+
+    # Conditions
+    pGood = 0.23
+    pExcellent = 0.01
+
+    # Step 1 is always normal
+    ppGood = 0
+    ppExcellent = 0
+    ppPoor = 0
+    ppNormal = 1 - (ppGood + ppExcellent + ppPoor)
+
+    if startState is not None:
+        if cache is not None:
+            raise ValueError("A state cache cannot be used with a start state")
+        (durabilityState, cpState, qualityState, progressState, wastedActions, trickUses, iqStacks, expiry, liveSteps,
+         crossClassIds, finishStep, ppGood, ppExcellent, ppPoor, ppNormal) = startState
+        expiry = list(expiry)
+        crossClassIds = set(crossClassIds)
+
+    # Resume from the longest cached prefix
+    stepCount = 0
+    cacheNode = None
+    if cache is not None:
+        if cache.synth is not synth:
+            raise ValueError("State cache was created for a different synth")
+        cacheNode, stepCount, snapshot = cache.lookup([action.id for action in individual])
+        if snapshot is not None:
+            (durabilityState, cpState, qualityState, progressState, wastedActions, trickUses, iqStacks, expiry, liveSteps,
+             crossClassIds, finishStep, ppGood, ppExcellent, ppPoor, ppNormal) = snapshot
+            expiry = list(expiry)
+            crossClassIds = set(crossClassIds)
+
+    iqSlot = innerQuiet.effectSlot
+    innovationSlot = innovation.effectSlot
+    ingenuitySlot = ingenuity.effectSlot
+    ingenuity2Slot = ingenuity2.effectSlot
+    steadyHandSlot = steadyHand.effectSlot
+    steadyHand2Slot = steadyHand2.effectSlot
+    greatStridesSlot = greatStrides.effectSlot
+    wasteNotSlot = wasteNot.effectSlot
+    wasteNot2Slot = wasteNot2.effectSlot
+    manipulationSlot = manipulation.effectSlot
+    comfortZoneSlot = comfortZone.effectSlot
+    dummyId = dummyAction.id
+    flawlessSynthesisId = flawlessSynthesis.id
+    pieceByPieceId = pieceByPiece.id
+    byregotsBlessingId = byregotsBlessing.id
+    mastersMendId = mastersMend.id
+    mastersMend2Id = mastersMend2.id
+    ruminationId = rumination.id
+    tricksOfTheTradeId = tricksOfTheTrade.id
+
+    gainTables = synth.gainTables()
+    baseProgress = gainTables.progress
+    baseQuality = gainTables.quality
+    baseLevelDifference = crafter.level - recipe.level
+
+    for action in individual[stepCount:]:
+        actionId = action.id
+        stepCount += 1
+
+        # Add effect modifiers
+        levelDifference = baseLevelDifference
+        if expiry[ingenuity2Slot] > liveSteps:
+            levelDifference = 3
+        elif expiry[ingenuitySlot] > liveSteps:
+            levelDifference = 0
+
+        if expiry[steadyHand2Slot] > liveSteps:
+            successProbability = action.successProbability + 0.3
+        elif expiry[steadyHandSlot] > liveSteps:
+            successProbability = action.successProbability + 0.2
+        else:
+            successProbability = action.successProbability
+        successProbability = min(successProbability, 1)
+
+        actionQualityMultiplier = action.qualityIncreaseMultiplier
+        qualityIncreaseMultiplier = actionQualityMultiplier
+        if expiry[greatStridesSlot] > liveSteps:
+            qualityIncreaseMultiplier *= 2
+
+        # Condition Calculation
+        if useConditions:
+            qualityIncreaseMultiplier *= (1*ppNormal + 1.5*ppGood + 4*ppExcellent + 0.5*ppPoor)
+
+        # Occur if a dummy action
+        #==================================
+        if (progressState >= difficulty or durabilityState <= 0) and actionId != dummyId:
+            wastedActions += 1
+            if finishStep is None:
+                finishStep = liveSteps
+
+        # Occur if not a dummy action
+        #==================================
+        else:
+            # Calculate final gains / losses
+            if actionId == flawlessSynthesisId:
+                bProgressGain = 40
+            elif actionId == pieceByPieceId:
+                bProgressGain = (difficulty - progressState)/3
+            else:
+                bProgressGain = action.progressIncreaseMultiplier * baseProgress[levelDifference]
+
+            innovationActive = expiry[innovationSlot] > liveSteps
+            bQuality = baseQuality.get((levelDifference, iqStacks, innovationActive))
+            if bQuality is None:
+                bQuality = gainTables.baseQuality(levelDifference, iqStacks, innovationActive)
+            bQualityGain = qualityIncreaseMultiplier * bQuality
+            qualityGain = successProbability * bQualityGain
+            if actionId == byregotsBlessingId and iqStacks is not None:
+                qualityGain *= (1 + 0.2 * iqStacks)
+
+            durabilityCost = action.durabilityCost
+            if expiry[wasteNotSlot] > liveSteps or expiry[wasteNot2Slot] > liveSteps:
+                durabilityCost = 0.5 * action.durabilityCost
+
+            # State tracking
+            progressState += successProbability * bProgressGain
+            qualityState += qualityGain
+            durabilityState -= durabilityCost
+            cpState -= action.cpCost
+
+            # Effect management
+            #==================================
+            # Special Effect Actions
+            if actionId == mastersMendId:
+                durabilityState += 30
+
+            if actionId == mastersMend2Id:
+                durabilityState += 60
+
+            if expiry[manipulationSlot] > liveSteps and durabilityState > 0:
+                durabilityState += 10
+
+            if expiry[comfortZoneSlot] > liveSteps and cpState > 0:
+                cpState += 8
+
+            if actionId == ruminationId and cpState > 0:
+                if iqStacks is not None and iqStacks > 0:
+                    cpState += (21 * iqStacks - iqStacks**2 + 10)/2
+                    iqStacks = None
+                else:
+                    wastedActions += 1
+
+            if actionId == byregotsBlessingId:
+                if iqStacks is not None:
+                    iqStacks = None
+                else:
+                    wastedActions += 1
+
+            if actionQualityMultiplier > 0:
+                expiry[greatStridesSlot] = 0
+
+            if actionId == tricksOfTheTradeId and cpState > 0:
+                trickUses += 1
+                cpState += 20
+
+            # Conditions
+            if useConditions:
+                ppPoor = ppExcellent
+                ppGood = pGood * ppNormal
+                ppExcellent = pExcellent * ppNormal
+                ppNormal = 1 - (ppGood + ppExcellent + ppPoor)
+
+            # Counting the step expires the effects that were due to end
+            liveSteps += 1
+
+            # Increment countups
+            if actionQualityMultiplier > 0 and iqStacks is not None:
+                iqStacks += 1 * successProbability
+
+            # Initialize new effects after countdowns are managed to reset them properly
+            # Inner Quiet is the only countup effect
+            if action.type == "countup":
+                iqStacks = 0
+            elif action.type == "countdown":
+                expiry[action.effectSlot] = liveSteps + action.activeTurns
+
+            # Sanity checks for state variables
+            durabilityState = min(durabilityState, maxDurability)
+            cpState = min(cpState, maxCp)
+
+            # Count cross class actions
+            if not (action.cls == "All" or action.cls == crafterCls):
+                crossClassIds.add(actionId)
+
+        if cacheNode is not None:
+            cacheNode = cache.extend(cacheNode, actionId, FitnessState(durabilityState, cpState, qualityState, progressState, wastedActions, trickUses, iqStacks,
+                                                                       tuple(expiry), liveSteps, frozenset(crossClassIds), finishStep,
+                                                                       ppGood, ppExcellent, ppPoor, ppNormal))
+
+    # Penalise failure outcomes
+    penalties = wastedActions
+    if progressState < difficulty:
+        penalties += 1
+    if cpState < 0:
+        penalties += 1
+    if not (durabilityState >= 0 and progressState >= difficulty):
+        penalties += 1
+    if trickUses > synth.maxTrickUses:
+        penalties += 1
+
+    result = (qualityState, progressState, penalties, len(crossClassIds))
+    if reportFinish:
+        result += (finishStep,)
+    if reportState:
+        result += (FitnessState(durabilityState, cpState, qualityState, progressState, wastedActions, trickUses, iqStacks,
+                                tuple(expiry), liveSteps, frozenset(crossClassIds), finishStep, ppGood, ppExcellent, ppPoor, ppNormal),)
+    return result
+
+def startFitnessState(synth):
+    """:class:`FitnessState` at the start of a synth, before any action."""
+    return FitnessState(synth.recipe.durability, synth.crafter.craftPoints, synth.recipe.startQuality, 0, 0, 0, None,
+                        nEffectSlots * (0,), 0, frozenset(), None, 0, 0, 0, 1)
+
+# Condition probabilities of a step known to have the given condition
+conditionProbabilities = {
+    "normal": (0, 0, 0, 1),
+    "good": (1, 0, 0, 0),
+    "excellent": (0, 1, 0, 0),
+    "poor": (0, 0, 1, 0),
+}
+
+def liveFitnessState(synth, durability, cp, progress, quality, iqStacks=None, effects=None, condition="normal",
+                     trickUses=0, crossClassActions=()):
+    """:class:`FitnessState` of a synth in progress, as read off the game.
+
+    *iqStacks* is the number of Inner Quiet stacks or None if Inner Quiet is
+    not active. *effects* maps the short names of the countdown Actions whose
+    buffs are active to the number of turns they have left. *condition* is
+    the condition of the next step, one of "normal", "good", "excellent" and
+    "poor". The cross class actions already used count towards the crafter's
+    limit.
+    """
+    expiry = nEffectSlots * [0]
+    for shortName, turnsLeft in (effects or {}).items():
+        action = allActions.get(shortName)
+        if action is None or action.type != "countdown":
+            raise ValueError("%s is not an action with a countdown effect" % shortName)
+        expiry[action.effectSlot] = turnsLeft
+    if condition not in conditionProbabilities:
+        raise ValueError("Unknown condition: %s" % condition)
+    ppGood, ppExcellent, ppPoor, ppNormal = conditionProbabilities[condition]
+    crossClassIds = frozenset(action.id for action in crossClassActions
+                              if not (action.cls == "All" or action.cls == synth.crafter.cls))
+    return FitnessState(durability, cp, quality, progress, 0, trickUses, iqStacks, tuple(expiry), 0, crossClassIds, None,
+                        ppGood, ppExcellent, ppPoor, ppNormal)
+
 # MoneCarlo Simulation Function
-def MonteCarloSynth(individual, synth, verbose=True, debug=False, logOutput=None):
+def MonteCarloSynth(individual, synth, verbose=True, debug=False, logOutput=None, rng=None, randomStreams=None):
+    """Simulate one random outcome of a sequence of Actions.
+
+    *rng* is the random number generator to draw conditions and successes
+    from, by default the global random module. Alternatively *randomStreams*
+    is a (condRands, successRands) pair of pre-generated uniform numbers
+    indexed by step, so that several sequences can be simulated against the
+    same conditions and successes.
+    """
+    if rng is None:
+        rng = random
+
+    condRands = successRands = None
+    if randomStreams is not None:
+        condRands, successRands = randomStreams
+
     logger = Logger(logOutput)
 
     # State tracking
@@ -401,10 +872,24 @@ def MonteCarloSynth(individual, synth, verbose=True, debug=False, logOutput=None
     stepCount = 0
     wastedActions = 0
     effects = EffectTracker()
+    countUps = effects.countUps
+    countDowns = effects.countDowns
+    iqSlot = innerQuiet.effectSlot
+    innovationSlot = innovation.effectSlot
+    ingenuitySlot = ingenuity.effectSlot
+    ingenuity2Slot = ingenuity2.effectSlot
+    steadyHandSlot = steadyHand.effectSlot
+    steadyHand2Slot = steadyHand2.effectSlot
+    greatStridesSlot = greatStrides.effectSlot
+    wasteNotSlot = wasteNot.effectSlot
+    wasteNot2Slot = wasteNot2.effectSlot
+    manipulationSlot = manipulation.effectSlot
+    comfortZoneSlot = comfortZone.effectSlot
     maxTricksUses = synth.maxTrickUses
     trickUses = 0
     crossClassActionList = []
     condition = "Normal"
+    gainTables = synth.gainTables()
 
     # Strip Tricks of the Trade
     individual = [x for x in individual if x != tricksOfTheTrade]
@@ -437,30 +922,29 @@ def MonteCarloSynth(individual, synth, verbose=True, debug=False, logOutput=None
         stepCount += 1
 
         # Add effect modifiers
-        craftsmanship = synth.crafter.craftsmanship
         control = synth.crafter.control
-        if innerQuiet.name in effects.countUps:
-            control *= (1 + 0.2 * effects.countUps[innerQuiet.name])
+        if countUps[iqSlot] is not None:
+            control *= (1 + 0.2 * countUps[iqSlot])
 
-        if innovation.name in effects.countDowns:
+        if countDowns[innovationSlot]:
             control *= 1.5
 
         levelDifference = synth.crafter.level - synth.recipe.level
-        if ingenuity2.name in effects.countDowns:
+        if countDowns[ingenuity2Slot]:
             levelDifference = 3
-        elif ingenuity.name in effects.countDowns:
+        elif countDowns[ingenuitySlot]:
             levelDifference = 0
 
-        if steadyHand2.name in effects.countDowns:
+        if countDowns[steadyHand2Slot]:
             successProbability = action.successProbability + 0.3        # What is effect of having both active? Assume 2 always overrides 1 but does not overwrite
-        elif steadyHand.name in effects.countDowns:
+        elif countDowns[steadyHandSlot]:
             successProbability = action.successProbability + 0.2
         else:
             successProbability = action.successProbability
         successProbability = min(successProbability, 1)
 
         qualityIncreaseMultiplier = action.qualityIncreaseMultiplier
-        if greatStrides.name in effects.countDowns:
+        if countDowns[greatStridesSlot]:
             qualityIncreaseMultiplier *= 2
 
         # Condition Calculation
@@ -470,7 +954,10 @@ def MonteCarloSynth(individual, synth, verbose=True, debug=False, logOutput=None
         elif condition == "Good" or condition == "Poor":
             condition = "Normal"
         else:
-            condRand = random.uniform(0,1)
+            if condRands is None:
+                condRand = rng.uniform(0,1)
+            else:
+                condRand = condRands[stepCount - 1]
             if 0 <= condRand < pExcellent:
                 condition = "Excellent"
                 qualityIncreaseMultiplier *= 4
@@ -490,29 +977,32 @@ def MonteCarloSynth(individual, synth, verbose=True, debug=False, logOutput=None
 
         # Calculate final gains / losses
         success = 0
-        successRand = random.uniform(0,1)
+        if successRands is None:
+            successRand = rng.uniform(0,1)
+        else:
+            successRand = successRands[stepCount - 1]
         if 0 <= successRand <= successProbability:
             success = 1
 
-        bProgressGain = action.progressIncreaseMultiplier * synth.CalculateBaseProgressIncrease(levelDifference, craftsmanship)
-        if action == flawlessSynthesis:
+        bProgressGain = action.progressIncreaseMultiplier * gainTables.progress[levelDifference]
+        if action.id == flawlessSynthesis.id:
             bProgressGain = 40
-        elif action == pieceByPiece:
+        elif action.id == pieceByPiece.id:
             bProgressGain = (synth.recipe.difficulty - progressState)/3
         progressGain = success * bProgressGain
 
-        bQualityGain = qualityIncreaseMultiplier * synth.CalculateBaseQualityIncrease(levelDifference, control)
+        bQualityGain = qualityIncreaseMultiplier * gainTables.baseQuality(levelDifference, countUps[iqSlot], countDowns[innovationSlot] > 0)
         qualityGain = success * bQualityGain
-        if action == byregotsBlessing and innerQuiet.name in effects.countUps:
-            qualityGain *= (1 + 0.2 * effects.countUps[innerQuiet.name])
+        if action.id == byregotsBlessing.id and countUps[iqSlot] is not None:
+            qualityGain *= (1 + 0.2 * countUps[iqSlot])
 
         durabilityCost = action.durabilityCost
-        if wasteNot.name in effects.countDowns or wasteNot2.name in effects.countDowns:
+        if countDowns[wasteNotSlot] or countDowns[wasteNot2Slot]:
             durabilityCost = 0.5 * action.durabilityCost
 
         # Occur if a dummy action
         #==================================
-        if (progressState >= synth.recipe.difficulty or durabilityState <= 0) and action != dummyAction:
+        if (progressState >= synth.recipe.difficulty or durabilityState <= 0) and action.id != dummyAction.id:
             wastedActions += 1
 
         # Occur if not a dummy action
@@ -527,54 +1017,53 @@ def MonteCarloSynth(individual, synth, verbose=True, debug=False, logOutput=None
             # Effect management
             #==================================
             # Special Effect Actions
-            if action == mastersMend:
+            if action.id == mastersMend.id:
                 durabilityState += 30
 
-            if action == mastersMend2:
+            if action.id == mastersMend2.id:
                 durabilityState += 60
 
-            if manipulation.name in effects.countDowns and durabilityState > 0:
+            if countDowns[manipulationSlot] and durabilityState > 0:
                 durabilityState += 10
 
-            if comfortZone.name in effects.countDowns and cpState > 0:
+            if countDowns[comfortZoneSlot] and cpState > 0:
                 cpState += 8
 
-            if action == rumination and cpState > 0:
-                if innerQuiet.name in effects.countUps and effects.countUps[innerQuiet.name] > 0:
-                    cpState += (21 * effects.countUps[innerQuiet.name] - effects.countUps[innerQuiet.name]**2 + 10)/2
-                    del effects.countUps[innerQuiet.name]
+            if action.id == rumination.id and cpState > 0:
+                if countUps[iqSlot] is not None and countUps[iqSlot] > 0:
+                    cpState += (21 * countUps[iqSlot] - countUps[iqSlot]**2 + 10)/2
+                    countUps[iqSlot] = None
                 else:
                     wastedActions += 1
 
-            if action == byregotsBlessing:
-                if innerQuiet.name in effects.countUps:
-                    del effects.countUps[innerQuiet.name]
+            if action.id == byregotsBlessing.id:
+                if countUps[iqSlot] is not None:
+                    countUps[iqSlot] = None
                 else:
                     wastedActions += 1
 
-            if action.qualityIncreaseMultiplier > 0 and greatStrides.name in effects.countDowns:
-                del effects.countDowns[greatStrides.name]
+            if action.qualityIncreaseMultiplier > 0 and countDowns[greatStridesSlot]:
+                countDowns[greatStridesSlot] = 0
 
-            if action == tricksOfTheTrade and cpState > 0:
+            if action.id == tricksOfTheTrade.id and cpState > 0:
                 trickUses += 1
                 cpState += 20
 
             # Decrement countdowns
-            for countDown in list(effects.countDowns.keys()):
-                effects.countDowns[countDown] -= 1
-                if effects.countDowns[countDown] == 0:
-                    del effects.countDowns[countDown]
+            for slot in range(nEffectSlots):
+                if countDowns[slot]:
+                    countDowns[slot] -= 1
 
             # Increment countups
-            if action.qualityIncreaseMultiplier > 0 and innerQuiet.name in effects.countUps:
-                effects.countUps[innerQuiet.name] += 1 * success
+            if action.qualityIncreaseMultiplier > 0 and countUps[iqSlot] is not None:
+                countUps[iqSlot] += 1 * success
 
             # Initialize new effects after countdowns are managed to reset them properly
             if action.type == "countup":
-                effects.countUps[action.name] = 0
+                countUps[action.effectSlot] = 0
 
             if action.type == "countdown":
-                effects.countDowns[action.name] = action.activeTurns
+                countDowns[action.effectSlot] = action.activeTurns
 
             # Sanity checks for state variables
             durabilityState = min(durabilityState, synth.recipe.durability)
@@ -589,8 +1078,8 @@ def MonteCarloSynth(individual, synth, verbose=True, debug=False, logOutput=None
 
         if debug:
             iqCnt = 0
-            if innerQuiet.name in effects.countUps:
-                iqCnt = effects.countUps[innerQuiet.name]
+            if countUps[iqSlot] is not None:
+                iqCnt = countUps[iqSlot]
             logger.log("%2i %-20s %5i %5i %8.1f %5.1f %5i %5.1f %5i %5i %5i %5i" % (stepCount, action.name, durabilityState, cpState, qualityState, progressState, wastedActions, iqCnt, control, qualityGain, bProgressGain, bQualityGain))
 
     # Penalise failure outcomes
@@ -617,49 +1106,313 @@ def MonteCarloSynth(individual, synth, verbose=True, debug=False, logOutput=None
 
     return finalState
 
-def MonteCarloSim(individual, synth, nRuns=100, seed=None, verbose=False, debug=False, logOutput=None):
+def MonteCarloSim(individual, synth, nRuns=100, seed=None, verbose=False, debug=False, logOutput=None, vectorized=False,
+                  hqMode="sample", percentiles=None, confidence=None, processes=None, chunkSize=250,
+                  hqPrecision=None, qualityPrecision=None, batchSize=100, rng=None):
+    """Monte Carlo simulation of a sequence of Actions over nRuns trials.
+
+    Each run is folded into streaming statistics as it finishes, so memory
+    does not grow with nRuns.
+
+    With *hqMode* "sample" the HQ% is estimated by drawing whether each run is
+    HQ. With "analytic" the HQ probabilities of the runs are averaged instead.
+    *percentiles* optionally adds percentiles of the per run HQ% and quality,
+    and *confidence* a confidence interval for the average HQ%. Percentiles
+    come from a :class:`~mcstats.QuantileSketch`, which is only accurate
+    between about the 5th and 95th percentile once nRuns is large.
+
+    If *processes* is given the runs are split into chunks of *chunkSize*
+    runs that are simulated by a pool of that many worker processes. Every
+    chunk draws from its own generator seeded from *seed*, so the result
+    only depends on the seed and the chunk size, not on the number of
+    processes. Per run output is not logged in this mode.
+
+    If *hqPrecision* or *qualityPrecision* is given the runs are done in
+    batches of *batchSize* until the confidence intervals of the average HQ%
+    and quality are within plus or minus that precision, or nRuns runs were
+    done. The intervals use *confidence*, 0.95 if not given.
+
+    Random numbers are drawn from *rng*, a :class:`random.Random` instance,
+    or one seeded with *seed* if not given, so that simulations on different
+    threads do not interfere.
+
+    :returns: A :class:`MonteCarloResult`.
+    """
     if seed is None:
-        seed = random.randint(0, 19770216)
-    random.seed(seed)
+        seed = (rng or random).randint(0, 19770216)
+    if rng is None:
+        rng = random.Random(seed)
 
     logger = Logger(logOutput)
+    sketch = bool(percentiles)
+
+    adaptive = hqPrecision is not None or qualityPrecision is not None
+    if adaptive and not confidence:
+        confidence = 0.95
+
+    pool = None
+    if processes:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        chunkSeeds = random.Random(seed)
+
+    stats = None
+    converged = None
+    nBatches = 0
+    try:
+        while stats is None or stats[2].n < nRuns:
+            runsLeft = nRuns if stats is None else nRuns - stats[2].n
+            if adaptive:
+                runsLeft = min(runsLeft, batchSize)
+
+            if pool is not None:
+                chunks = []
+                for start in range(0, runsLeft, chunkSize):
+                    chunks.append((individual, synth, min(chunkSize, runsLeft - start), chunkSeeds.randint(0, 2**31 - 1), vectorized, hqMode, sketch))
+                batchStats = pool.map(monteCarloChunk, chunks)
+            else:
+                batchStats = [monteCarloStats(individual, synth, runsLeft, seed + nBatches, rng, vectorized, hqMode, sketch, verbose, debug, logOutput)]
+            nBatches += 1
 
-    finalStateTracker = []
-    for i in range(nRuns):
-        runSynth = MonteCarloSynth(individual, synth, False, debug, logOutput)
-        finalStateTracker.append(runSynth)
+            # Merge in chunk order so that the result does not depend on scheduling
+            for chunkStats in batchStats:
+                if stats is None:
+                    stats = chunkStats
+                else:
+                    for runningStats, otherStats in zip(stats, chunkStats):
+                        runningStats.merge(otherStats)
 
-        if verbose:
-            logger.log("%2i %-20s %5i %5i %8.1f %5.1f %5i" % (i, "MonteCarlo", runSynth.durabilityState, runSynth.cpState, runSynth.qualityState, runSynth.progressState, runSynth.wastedActions))
+            if adaptive:
+                converged = precisionReached(stats[4], hqPrecision, confidence) and precisionReached(stats[2], qualityPrecision, confidence)
+                if converged:
+                    break
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
-    avgDurability = sum([x.durabilityState for x in finalStateTracker])/nRuns
-    avgCp = sum([x.cpState for x in finalStateTracker])/nRuns
-    avgQuality = sum([x.qualityState for x in finalStateTracker])/nRuns
-    avgProgress = sum([x.progressState for x in finalStateTracker])/nRuns
-    avgHqPercent = getAverageHqPercent(finalStateTracker, synth)
+    durability, cp, quality, progress, hq = stats
+
+    minHqPercent = hqPercentFromQuality(quality.minimum/synth.recipe.maxQuality * 100)
+    result = MonteCarloResult(durability, cp, quality, progress, hq, minHqPercent, percentiles, confidence, converged)
 
     logger.log("%2s %-20s %5s %5s %8s %5s %5s" % ("", "", "DUR", "CP", "QUA", "PRG", "HQ%"))
-    logger.log("%2s %-20s %5i %5i %8.1f %5.1f %5i" % ("##", "Expected Value: ", avgDurability, avgCp, avgQuality, avgProgress, avgHqPercent))
+    logger.log("%2s %-20s %5i %5i %8.1f %5.1f %5i" % ("##", "Expected Value: ", durability.mean, cp.mean, quality.mean, progress.mean, hq.mean))
+    logger.log("%2s %-20s %5i %5i %8.1f %5.1f %5i" % ("##", "Min Value: ", durability.minimum, cp.minimum, quality.minimum, progress.minimum, minHqPercent))
+
+    if confidence:
+        hqLow, hqHigh = hq.confidenceInterval(confidence)
+        logger.log("%2s %-20s %5.1f - %5.1f" % ("##", "HQ%% %i%% CI: " % (confidence * 100,), hqLow, hqHigh))
+
+    if adaptive:
+        logger.log("%2s %-20s %5i %s" % ("##", "Runs: ", quality.n, "(converged)" if converged else "(run limit reached)"))
+
+    return result
+
+def precisionReached(stats, precision, confidence):
+    """True if the confidence interval of the mean of stats is within plus or
+    minus precision, or no precision is required."""
+    if precision is None:
+        return True
+    if stats.n < 2:
+        return False
+    low, high = stats.confidenceInterval(confidence)
+    return (high - low) / 2 <= precision
+
+def monteCarloStats(individual, synth, nRuns, seed, rng, vectorized=False, hqMode="sample", sketch=False, verbose=False, debug=False, logOutput=None):
+    """Simulate nRuns outcomes of a sequence and accumulate their final states.
+
+    *rng* draws the outcomes of the scalar simulator and the HQ coin flips,
+    *seed* seeds the vectorized simulator.
+
+    :returns: A list of :class:`~mcstats.RunningStats` of the durability, CP,
+              quality, progress and HQ% of the runs.
+    """
+    logger = Logger(logOutput)
+
+    durability = mcstats.RunningStats()
+    cp = mcstats.RunningStats()
+    quality = mcstats.RunningStats(sketch=sketch)
+    progress = mcstats.RunningStats()
+    hq = mcstats.RunningStats(sketch=sketch)
+
+    if vectorized:
+        # Run all trials at once with the NumPy engine
+        import batchsim
+        finalStates = batchsim.monteCarloBatch(individual, synth, nRuns, seed)
 
-    minDurability = min([x.durabilityState for x in finalStateTracker])
-    minCp = min([x.cpState for x in finalStateTracker])
-    minQuality = min([x.qualityState for x in finalStateTracker])
-    minProgress = min([x.progressState for x in finalStateTracker])
-    minQualityPercent = minQuality/synth.recipe.maxQuality * 100
-    minHqPercent = hqPercentFromQuality(minQualityPercent)
+        if verbose:
+            for i in range(nRuns):
+                logger.log("%2i %-20s %5i %5i %8.1f %5.1f %5i" % (i, "MonteCarlo", finalStates.durabilityState[i], finalStates.cpState[i], finalStates.qualityState[i], finalStates.progressState[i], finalStates.wastedActions[i]))
+
+        hqPercents = batchsim.hqPercentFromQualityArray(finalStates.qualityState / synth.recipe.maxQuality * 100)
+        if hqMode != "analytic":
+            hqRand = batchsim.np.array([rng.uniform(0,1) for i in range(nRuns)])
+            hqPercents = 100.0 * (hqRand <= hqPercents / 100.0)
+
+        batchsim.addToRunningStats(durability, finalStates.durabilityState)
+        batchsim.addToRunningStats(cp, finalStates.cpState)
+        batchsim.addToRunningStats(quality, finalStates.qualityState)
+        batchsim.addToRunningStats(progress, finalStates.progressState)
+        batchsim.addToRunningStats(hq, hqPercents)
+    else:
+        for i in range(nRuns):
+            runSynth = MonteCarloSynth(individual, synth, False, debug, logOutput, rng)
+
+            if verbose:
+                logger.log("%2i %-20s %5i %5i %8.1f %5.1f %5i" % (i, "MonteCarlo", runSynth.durabilityState, runSynth.cpState, runSynth.qualityState, runSynth.progressState, runSynth.wastedActions))
+
+            durability.add(runSynth.durabilityState)
+            cp.add(runSynth.cpState)
+            quality.add(runSynth.qualityState)
+            progress.add(runSynth.progressState)
+            hq.add(runHqPercent(runSynth.qualityState, synth, hqMode, rng))
+
+    return [durability, cp, quality, progress, hq]
+
+def monteCarloChunk(args):
+    """Worker entry point of the parallel Monte Carlo simulation."""
+    individual, synth, nRuns, seed, vectorized, hqMode, sketch = args
+    return monteCarloStats(individual, synth, nRuns, seed, random.Random(seed), vectorized, hqMode, sketch)
+
+def runHqPercent(qualityState, synth, hqMode="sample", rng=None):
+    """HQ% contributed by one Monte Carlo run: its HQ probability in percent
+    with hqMode "analytic", or 100 or 0 from a random draw with "sample"."""
+    if rng is None:
+        rng = random
+
+    qualityPercent = qualityState / synth.recipe.maxQuality * 100
+    hqPercent = hqPercentFromQuality(qualityPercent)
+    if hqMode == "analytic":
+        return hqPercent
+
+    hqRand = rng.uniform(0,1)
+    if hqRand <= hqPercent / 100.0:
+        return 100.0
+    return 0.0
+
+class SequenceComparison:
+    """Paired Monte Carlo comparison of several sequences.
+
+    quality and hq hold a :class:`~mcstats.RunningStats` of the final quality
+    and HQ% of each sequence. qualityDifferences and hqDifferences hold the
+    paired differences of each sequence to the first one. There is one
+    sample per run, or per antithetic pair of runs averaged.
+    """
+    def __init__(self, quality, hq, qualityDifferences, hqDifferences, antithetic):
+        self.nRuns = quality[0].n * (2 if antithetic else 1) if quality else 0
+        self.quality = quality
+        self.hq = hq
+        self.qualityDifferences = qualityDifferences
+        self.hqDifferences = hqDifferences
+        self.antithetic = antithetic
+
+    def toDict(self):
+        result = {
+            "nRuns": self.nRuns,
+            "antithetic": self.antithetic,
+            "sequences": [],
+        }
+        for i in range(len(self.quality)):
+            result["sequences"].append({
+                "quality": self.quality[i].mean,
+                "qualityStdError": self.quality[i].stdError(),
+                "hqPercent": self.hq[i].mean,
+                "hqPercentStdError": self.hq[i].stdError(),
+                "qualityDifference": self.qualityDifferences[i].mean,
+                "qualityDifferenceStdError": self.qualityDifferences[i].stdError(),
+                "hqPercentDifference": self.hqDifferences[i].mean,
+                "hqPercentDifferenceStdError": self.hqDifferences[i].stdError(),
+            })
+        return result
+
+def compareSequences(individuals, synth, nRuns=100, seed=None, antithetic=False, hqMode="analytic", logOutput=None, rng=None):
+    """Compare sequences of Actions by Monte Carlo with common random numbers.
+
+    Every run draws one stream of condition and success random numbers that
+    all the sequences are simulated against, so the differences between them
+    are not buried in the noise of independent draws. With *antithetic* the
+    runs come in pairs where the second run uses 1 - u for every random
+    number u of the first, so *nRuns* must then be even; an odd number
+    raises a ValueError. The streams are drawn from *rng*, or a
+    :class:`random.Random` seeded with *seed* if not given.
+
+    :returns: A :class:`SequenceComparison` where differences are taken to
+              the first sequence.
+    """
+    if antithetic and nRuns % 2:
+        raise ValueError("Antithetic runs come in pairs, nRuns must be even: %i" % nRuns)
 
-    logger.log("%2s %-20s %5i %5i %8.1f %5.1f %5i" % ("##", "Min Value: ", minDurability, minCp, minQuality, minProgress, minHqPercent))
+    if rng is None:
+        if seed is None:
+            seed = random.randint(0, 19770216)
+        rng = random.Random(seed)
+
+    logger = Logger(logOutput)
+
+    nSequences = len(individuals)
+    nSteps = max([len(individual) for individual in individuals] + [0])
+    quality = [mcstats.RunningStats() for i in range(nSequences)]
+    hq = [mcstats.RunningStats() for i in range(nSequences)]
+    qualityDifferences = [mcstats.RunningStats() for i in range(nSequences)]
+    hqDifferences = [mcstats.RunningStats() for i in range(nSequences)]
+
+    def hqOfRun(qualityState, hqRand):
+        hqPercent = hqPercentFromQuality(qualityState / synth.recipe.maxQuality * 100)
+        if hqMode == "analytic":
+            return hqPercent
+        if hqRand <= hqPercent / 100.0:
+            return 100.0
+        return 0.0
+
+    nSamples = nRuns // 2 if antithetic else nRuns
+    for i in range(nSamples):
+        condRands = [rng.uniform(0,1) for step in range(nSteps)]
+        successRands = [rng.uniform(0,1) for step in range(nSteps)]
+        hqRand = rng.uniform(0,1)
+        streams = [(condRands, successRands, hqRand)]
+        if antithetic:
+            streams.append(([1 - u for u in condRands], [1 - u for u in successRands], 1 - hqRand))
+
+        # Average over the antithetic pair so that each sample is independent
+        qualities = nSequences * [0.0]
+        hqPercents = nSequences * [0.0]
+        for condRands, successRands, hqRand in streams:
+            for j, individual in enumerate(individuals):
+                runSynth = MonteCarloSynth(individual, synth, False, False, None, randomStreams=(condRands, successRands))
+                runHq = hqOfRun(runSynth.qualityState, hqRand)
+                qualities[j] += float(runSynth.qualityState) / len(streams)
+                hqPercents[j] += float(runHq) / len(streams)
+
+        for j in range(nSequences):
+            quality[j].add(qualities[j])
+            hq[j].add(hqPercents[j])
+            qualityDifferences[j].add(qualities[j] - qualities[0])
+            hqDifferences[j].add(hqPercents[j] - hqPercents[0])
+
+    logger.log("%2s %-20s %8s %8s %8s %8s" % ("#", "Sequence", "QUA", "dQUA", "HQ%", "dHQ%"))
+    for j in range(nSequences):
+        logger.log("%2i %-20s %8.1f %8.1f %8.1f %8.1f" % (j, "", quality[j].mean, qualityDifferences[j].mean, hq[j].mean, hqDifferences[j].mean))
+        logger.log("%2s %-20s %8s %8.1f %8s %8.1f" % ("", "  +/- std. error", "", qualityDifferences[j].stdError(), "", hqDifferences[j].stdError()))
+
+    return SequenceComparison(quality, hq, qualityDifferences, hqDifferences, antithetic)
+
+def getAverageHqPercent(stateArray, synth, rng=None):
+    return getAverageHqPercentOfQualities([result.qualityState for result in stateArray], synth, rng)
+
+def getAverageHqPercentOfQualities(qualities, synth, rng=None):
+    if rng is None:
+        rng = random
 
-def getAverageHqPercent(stateArray, synth):
     nHQ = 0
-    for result in stateArray:
-        qualityPercent = result.qualityState / synth.recipe.maxQuality * 100
+    for quality in qualities:
+        qualityPercent = quality / synth.recipe.maxQuality * 100
         hqProbability = hqPercentFromQuality(qualityPercent) / 100.0
-        hqRand = random.uniform(0,1)
+        hqRand = rng.uniform(0,1)
         if hqRand <= hqProbability:
             nHQ += 1
 
-    return float(nHQ) / len(stateArray) * 100.0
+    return float(nHQ) / len(qualities) * 100.0
 
 def generateInitialGuess(synth, seqLength):
     nSynths = math.ceil(synth.recipe.difficulty / (0.9*synth.CalculateBaseProgressIncrease((synth.crafter.level-synth.recipe.level), synth.crafter.craftsmanship)) )
@@ -729,11 +1482,99 @@ for k, v in globals().items():
     if isinstance(v, Action):
         allActions[v.shortName] = v
 
+# Compiled action table
+#======================================
+def compileActionTable(actions):
+    """Assign each action a small integer id and each countup/countdown action
+    an effect slot. Returns the table of actions indexed by id and the number
+    of effect slots."""
+    table = sorted(actions, key=lambda a: a.shortName)
+    nSlots = 0
+    for i, action in enumerate(table):
+        action.id = i
+        if action.type != "immediate":
+            action.effectSlot = nSlots
+            nSlots += 1
+    return table, nSlots
+
+actionTable, nEffectSlots = compileActionTable(allActions.values())
+
 # Call to GA
-def mainGA(mySynth, penaltyWeight, seqLength, seed=None):
-    if seed is None:
-        seed = random.randint(0, 19770216)
-    random.seed(seed)
+class SolverTypes:
+    """Fitness and Individual types of one kind of solve, and the primitive
+    set of the individuals for GP solves."""
+    def __init__(self, FitnessMax, Individual, pset=None):
+        self.FitnessMax = FitnessMax
+        self.Individual = Individual
+        self.pset = pset
+
+class SolverContext:
+    """Registry of the DEAP types used by solves.
+
+    Types are built with :func:`deap.creator.createType` instead of being
+    registered as globals of :mod:`deap.creator`, and cached per set of
+    actions. Solves that share a context, including concurrent ones, reuse
+    the types of their action set instead of rebuilding or replacing them.
+    At most *maxTypes* sets of types are kept, the least recently used are
+    dropped first; solves still running with them are not affected.
+    """
+    def __init__(self, maxTypes=64):
+        self.types = OrderedDict()
+        self.maxTypes = maxTypes
+        self.lock = threading.Lock()
+
+    def _get(self, key, build):
+        """Cached types of a key, built by calling *build* if missing. Must
+        be called with the lock held."""
+        types = self.types.pop(key, None)
+        if types is None:
+            types = build()
+            if len(self.types) >= self.maxTypes:
+                self.types.popitem(last=False)
+        self.types[key] = types
+        return types
+
+    def gaTypes(self):
+        def build():
+            FitnessMax = creator.createType("FitnessMax", base.Fitness, weights=(1.0,))
+            Individual = creator.createType("Individual", list, fitness=FitnessMax)
+            return SolverTypes(FitnessMax, Individual)
+        with self.lock:
+            return self._get(("GA",), build)
+
+    def gpTypes(self, actions):
+        """Types of GP solves whose terminals are the given actions."""
+        def build():
+            # Create the set of primitives and terminals to set up the AST
+            pset = gp.PrimitiveSet("MAIN", 0)
+            pset.addPrimitive(prog2, 2)
+            for action in actions:
+                pset.addTerminal(action)
+
+            # Set up a maximization problem
+            FitnessMax = creator.createType("FitnessMax", base.Fitness, weights=(1.0, 0.1))
+            Individual = creator.createType("Individual", gp.PrimitiveTree, fitness=FitnessMax, pset=pset)
+            return SolverTypes(FitnessMax, Individual, pset)
+        with self.lock:
+            return self._get(("GP",) + tuple(action.id for action in actions), build)
+
+    def linearTypes(self):
+        """Types of solves with linear genomes of action ids."""
+        def build():
+            FitnessMax = creator.createType("FitnessMax", base.Fitness, weights=(1.0, 0.1))
+            Individual = creator.createType("Individual", array.array, typecode="B", fitness=FitnessMax)
+            return SolverTypes(FitnessMax, Individual)
+        with self.lock:
+            return self._get(("LINEAR",), build)
+
+# Shared by solves that are not given a context of their own
+defaultSolverContext = SolverContext()
+
+def mainGA(mySynth, penaltyWeight, seqLength, seed=None, rng=None, context=None):
+    if rng is None:
+        if seed is None:
+            seed = random.randint(0, 19770216)
+        rng = random.Random(seed)
 
     # Insert dummy action as padding
     myActions = list(mySynth.crafter.actions)
@@ -769,25 +1610,26 @@ def mainGA(mySynth, penaltyWeight, seqLength, seed=None):
 
     # GA Stuff
     #==============================
-    creator.create("FitnessMax", base.Fitness, weights=(1.0,))
-    creator.create("Individual", list, fitness=creator.FitnessMax)
+    if context is None:
+        context = defaultSolverContext
+    types = context.gaTypes()
 
     toolbox = base.Toolbox()
 
     # Attribute generator
-    toolbox.register("attr_action", random.choice, myActions)
+    toolbox.register("attr_action", rng.choice, myActions)
 
     # Structure initializers
-    toolbox.register("individual", tools.initRepeat, creator.Individual, toolbox.attr_action, seqLength)
+    toolbox.register("individual", tools.initRepeat, types.Individual, toolbox.attr_action, seqLength)
     toolbox.register("population", tools.initRepeat, list, toolbox.individual)
 
     toolbox.register("evaluate", evalSeq)
-    toolbox.register("mate", tools.cxOnePoint)
-    toolbox.register("mutate", tools.mutShuffleIndexes, indpb=0.05)
-    toolbox.register("select", tools.selTournament, tournsize=3)
+    toolbox.register("mate", tools.cxOnePoint, rng=rng)
+    toolbox.register("mutate", tools.mutShuffleIndexes, indpb=0.05, rng=rng)
+    toolbox.register("select", tools.selTournament, tournsize=3, rng=rng)
 
     # Set initial guess
-    iniGuess = creator.Individual(myInitialGuess)
+    iniGuess = types.Individual(myInitialGuess)
     pop = toolbox.population(n=300)
     pop.pop()
     pop.insert(0, iniGuess)
@@ -801,7 +1643,7 @@ def mainGA(mySynth, penaltyWeight, seqLength, seed=None):
 
     # Run GA
     #==============================
-    algorithms.eaSimple(pop, toolbox, cxpb=0.5, mutpb=0.2, ngen=50, stats=stats, halloffame=hof, verbose=True)
+    algorithms.eaSimple(pop, toolbox, cxpb=0.5, mutpb=0.2, ngen=50, stats=stats, halloffame=hof, verbose=True, rng=rng)
 
     # Print Best Individual
     #==============================
@@ -816,6 +1658,10 @@ def qualityFromHqPercent(hqPercent):
 
     return qualityPercent
 
+# qualityFromHqPercent increases over [1, 100], so it is inverted by bisecting
+# its values at each whole hqPercent, computed once at import.
+hqQualityThresholds = [qualityFromHqPercent(hqPercent) for hqPercent in range(1, 101)]
+
 def hqPercentFromQuality(qualityPercent):
 
     hqPercent = 1
@@ -824,13 +1670,21 @@ def hqPercentFromQuality(qualityPercent):
     elif qualityPercent >= 100:
         hqPercent = 100
     else:
-        while qualityFromHqPercent(hqPercent) < qualityPercent and hqPercent < 100:
-            hqPercent += 1
+        hqPercent = min(bisect.bisect_left(hqQualityThresholds, qualityPercent) + 1, 100)
 
     return hqPercent
 
+def evaluateIndividuals(individuals, toolbox):
+    """Evaluate a list of individuals, using the population-level
+    :meth:`toolbox.evaluate_batch` if one is registered and mapping
+    :meth:`toolbox.evaluate` over them otherwise."""
+    if hasattr(toolbox, "evaluate_batch"):
+        return toolbox.evaluate_batch(individuals)
+    return toolbox.map(toolbox.evaluate, individuals)
+
 def gpEvolution(population, toolbox, cxpb, mutpb, ngen, stats=None,
-             halloffame=None, verbose=False, logOutput=sys.stdout, progressFeedback=None):
+             halloffame=None, verbose=False, logOutput=sys.stdout, progressFeedback=None, rng=None, fitnessCache=None, migrate=None,
+             stagnationLimit=None, minStd=None, goal=None, runInfo=None, deadline=None, maxEvaluations=None):
     """This algorithm reproduce the simplest evolutionary algorithm as
     presented in chapter 7 of [Back2000]_.
 
@@ -839,13 +1693,40 @@ def gpEvolution(population, toolbox, cxpb, mutpb, ngen, stats=None,
                     operators.
     :param cxpb: The probability of mating two individuals.
     :param mutpb: The probability of mutating an individual.
-    :param ngen: The number of generation.
+    :param ngen: The number of generation, or None to run until another
+                 criterion ends the evolution.
     :param stats: A :class:`~deap.tools.Statistics` object that is updated
                   inplace, optional.
     :param halloffame: A :class:`~deap.tools.HallOfFame` object that will
                        contain the best individuals, optional.
     :param logOutput: File-like object to which log output should be written
                       or None for no log output.
+    :param rng: A :class:`random.Random` instance used for variation, the
+                :mod:`random` module when None.
+    :param fitnessCache: The :class:`~simcache.FitnessCache` used by the
+                         evaluation, if any, whose hit ratio in each
+                         generation is logged.
+    :param migrate: A function called after each generation with the
+                    generation number and the population. It may replace
+                    individuals of the population by individuals with a
+                    valid fitness.
+    :param stagnationLimit: Stop when the best fitness has not improved for
+                            this many generations.
+    :param minStd: Stop when the standard deviation of the first fitness
+                   value of the population falls below this.
+    :param goal: A function of an individual. Stop when it returns True
+                 for a new best individual.
+    :param deadline: Stop before a generation that would end after this
+                     :func:`time.time`, judging by the duration of the
+                     previous generation.
+    :param maxEvaluations: Stop once this many individuals were evaluated.
+    :param runInfo: A dictionary that is updated inplace with the number of
+                    generations run as "generations", the reason the
+                    evolution ended as "stopReason": "generations",
+                    "stopped", "stagnation", "converged", "goal", "time" or
+                    "evaluations", and the number of individuals evaluated
+                    as "evaluations" in "seconds", with their rate as
+                    "evaluationsPerSecond".
     :returns: The final population.
 
     It uses :math:`\lambda = \kappa = \mu` and goes as follow.
@@ -871,43 +1752,66 @@ def gpEvolution(population, toolbox, cxpb, mutpb, ngen, stats=None,
 
     This function expects :meth:`toolbox.mate`, :meth:`toolbox.mutate`,
     :meth:`toolbox.select` and :meth:`toolbox.evaluate` aliases to be
-    registered in the toolbox.
+    registered in the toolbox. If :meth:`toolbox.evaluate_batch` is also
+    registered, it is called once per generation with the list of individuals
+    to evaluate and must return their fitnesses in the same order.
 
     .. [Back2000] Back, Fogel and Michalewicz, "Evolutionary Computation 1 :
        Basic Algorithms and Operators", 2000.
     """
+    startTime = time.time()
+
     # Evaluate the individuals with an invalid fitness
     invalid_ind = [ind for ind in population if not ind.fitness.valid]
-    fitnesses = toolbox.map(toolbox.evaluate, invalid_ind)
+    fitnesses = evaluateIndividuals(invalid_ind, toolbox)
     for ind, fit in zip(invalid_ind, fitnesses):
         ind.fitness.values = fit
+    evaluations = len(invalid_ind)
 
     if halloffame is not None:
         halloffame.update(population)
     if stats is not None:
         stats.update(population)
+    def cacheHits():
+        if fitnessCache is None:
+            return {}
+        lookups = fitnessCache.lookups - cacheCounts[0]
+        hits = fitnessCache.hits - cacheCounts[1]
+        cacheCounts[:] = [fitnessCache.lookups, fitnessCache.hits]
+        return {"hits": "%.2f" % (float(hits) / lookups if lookups else 0.0)}
+    cacheCounts = [0, 0]
+
+    best = max(population, key=lambda ind: ind.fitness) if population else None
+    lastImprovement = 0
+    generationsRun = 0
+    stopReason = "generations"
+
     if verbose:
         column_names = ["gen", "evals"]
+        if fitnessCache is not None:
+            column_names += ["hits"]
         if stats is not None:
             column_names += stats.functions.keys()
         logger = tools.EvolutionLogger(column_names)
         logger.output = logOutput
         logger.logHeader()
-        logger.logGeneration(evals=len(population), gen=0, stats=stats)
+        logger.logGeneration(evals=len(population), gen=0, stats=stats, **cacheHits())
 
     # Begin the generational process
-    for gen in range(1, ngen+1):
+    generationStart = time.time()
+    for gen in (range(1, ngen+1) if ngen is not None else itertools.count(1)):
         # Select the next generation individuals
         offspring = toolbox.select(population, len(population))
 
         # Variate the pool of individuals
-        offspring = algorithms.varAnd(offspring, toolbox, cxpb, mutpb)
+        offspring = algorithms.varAnd(offspring, toolbox, cxpb, mutpb, rng)
 
         # Evaluate the individuals with an invalid fitness
         invalid_ind = [ind for ind in offspring if not ind.fitness.valid]
-        fitnesses = toolbox.map(toolbox.evaluate, invalid_ind)
+        fitnesses = evaluateIndividuals(invalid_ind, toolbox)
         for ind, fit in zip(invalid_ind, fitnesses):
             ind.fitness.values = fit
+        evaluations += len(invalid_ind)
 
         # Update the hall of fame with the generated individuals
         if halloffame is not None:
@@ -916,116 +1820,320 @@ def gpEvolution(population, toolbox, cxpb, mutpb, ngen, stats=None,
         # Replace the current population by the offspring
         population[:] = offspring
 
+        if migrate is not None:
+            migrate(gen, population)
+
         # Update the statistics with the new population
         if stats is not None:
             stats.update(population)
 
         if verbose:
-            logger.logGeneration(evals=len(invalid_ind), gen=gen, stats=stats)
+            logger.logGeneration(evals=len(invalid_ind), gen=gen, stats=stats, **cacheHits())
+
+        generationsRun = gen
+
+        # Track the best individual for the convergence criteria
+        genBest = max(population, key=lambda ind: ind.fitness) if population else None
+        improved = genBest is not None and (best is None or genBest.fitness > best.fitness)
+        if improved:
+            best = genBest
+            lastImprovement = gen
 
         if progressFeedback:
             if not progressFeedback(gen):
                 logOutput.write("Stop requested.\n")
+                stopReason = "stopped"
                 break
 
+        if stagnationLimit and gen - lastImprovement >= stagnationLimit:
+            Logger(logOutput).log("No improvement for %i generations." % stagnationLimit)
+            stopReason = "stagnation"
+            break
+
+        if minStd is not None and tools.std([ind.fitness.values[0] for ind in population]) < minStd:
+            Logger(logOutput).log("Population converged.")
+            stopReason = "converged"
+            break
+
+        if goal is not None and improved and goal(best):
+            Logger(logOutput).log("Goal reached.")
+            stopReason = "goal"
+            break
+
+        if maxEvaluations is not None and evaluations >= maxEvaluations:
+            Logger(logOutput).log("Evaluation budget used.")
+            stopReason = "evaluations"
+            break
+
+        # Assume the next generation takes as long as this one
+        now = time.time()
+        if deadline is not None and 2 * now - generationStart > deadline:
+            Logger(logOutput).log("Time budget used.")
+            stopReason = "time"
+            break
+        generationStart = now
+
+    if runInfo is not None:
+        seconds = time.time() - startTime
+        runInfo["generations"] = generationsRun
+        runInfo["stopReason"] = stopReason
+        runInfo["evaluations"] = evaluations
+        runInfo["seconds"] = seconds
+        runInfo["evaluationsPerSecond"] = evaluations / seconds if seconds > 0 else 0.0
+
     return population
 
 
-def mainGP(mySynth, penaltyWeight, population=300, generations=100, seed=None, initialGuess = None, verbose=False, logOutput=None, progressFeedback=None):
+# Synth of the evaluation worker processes of mainGP
+evaluationWorkerSynth = None
+
+def initEvaluationWorker(synth):
+    global evaluationWorkerSynth
+    evaluationWorkerSynth = synth
+
+def evaluationWorkerSimulate(encoded):
+    """Simulate a sequence given as a string of action ids in a worker.
+
+    :returns: The result of :func:`simFitness` with reportFinish.
+    """
+    actionIds = array.array("B")
+    actionIds.fromstring(encoded)
+    return simFitness([actionTable[actionId] for actionId in actionIds], evaluationWorkerSynth, reportFinish=True)
+
+def mainGP(mySynth, penaltyWeight, population=300, generations=100, seed=None, initialGuess = None, verbose=False, logOutput=None, progressFeedback=None, batchEvaluate=False, stateCacheSize=0, rng=None, context=None, fitnessCacheSize=100000,
+           genome="tree", maxLength=50, processes=None, migrate=None, stagnationGenerations=None, minFitnessStd=None, stopAtMaxQuality=False,
+           timeLimit=None, maxEvaluations=None, parsimonySize=None):
+    """Search for the best sequence of actions for a synth by genetic programming.
+
+    With *genome* "tree" individuals are binary trees of prog2 primitives
+    whose terminals are the actions. With "linear" they are arrays of action
+    ids, varied by segment crossover and insert, delete, swap and replace
+    mutations. Either way variation never produces sequences of more than
+    *maxLength* actions. With *parsimonySize* between 1 and 2, selection is
+    a double tournament that prefers the shorter of two individuals with
+    probability parsimonySize / 2.
+
+    With *batchEvaluate* each generation is evaluated at once by the NumPy
+    engine. With *processes* it is evaluated by a persistent pool of that
+    many worker processes instead.
+
+    *stateCacheSize* enables a :class:`~simcache.PrefixStateCache` of that
+    many states for evaluation. It is off by default: simFitness is cheap
+    enough that resuming from cached prefixes costs more than simulating
+    them again. *fitnessCacheSize* bounds the cache of whole sequences.
+
+    *migrate* is passed on to :func:`gpEvolution`, along with functions
+    that turn individuals into sequences of actions and back.
+
+    The run ends early when the best fitness has not improved for
+    *stagnationGenerations* generations, when the standard deviation of the
+    fitness of the population is below *minFitnessStd*, or with
+    *stopAtMaxQuality* when a sequence that passes all checks reaches the
+    recipe's max quality.
+
+    *timeLimit* in seconds and *maxEvaluations* bound the run alongside
+    *generations*, which may be None if one of them is given. The run then
+    ends with the best sequence found so far.
+
+    :returns: A (best sequence, its final State, population, hall of fame,
+              statistics, run info) tuple. The run info is a dictionary with
+              the number of generations run, the reason the run ended and
+              the number and rate of evaluations, see :func:`gpEvolution`.
+    """
     logger = Logger(logOutput)
 
+    deadline = None
+    if timeLimit is not None:
+        deadline = time.time() + timeLimit
+
+    if generations is None and timeLimit is None and maxEvaluations is None:
+        raise ValueError("generations, timeLimit or maxEvaluations must be given")
+
     if not initialGuess:
         initialGuess = None
 
-    # Do this be able to print the seed used
-    if seed is None:
-        seed = random.randint(0, 19770216)
-    random.seed(seed)
+    # Draw from a local generator so that concurrent solves do not interfere
+    if rng is None:
+        # Do this be able to print the seed used
+        if seed is None:
+            seed = random.randint(0, 19770216)
+        rng = random.Random(seed)
 
     myActions = mySynth.crafter.actions
 
-    # Create the set of primitives and terminals to set up the AST
-    pset = gp.PrimitiveSet("MAIN", 0)
-    pset.addPrimitive(prog2, 2)
-    for action in myActions:
-        pset.addTerminal(action)
-
-    # Set up a maximization problem
-    creator.create("FitnessMax", base.Fitness, weights=(1.0, 0.1))
-    creator.create("Individual", gp.PrimitiveTree, fitness=creator.FitnessMax, pset=pset)
+    if context is None:
+        context = defaultSolverContext
 
     toolbox = base.Toolbox()
 
-    # Tell the GP to pull from the set of primitives when selecting genes
-    toolbox.register("expr_init", gp.genFull, pset=pset, min_=1, max_=2)
+    if genome == "linear":
+        types = context.linearTypes()
+        genes = [action.id for action in myActions]
 
-    # Structure initializers
-    toolbox.register("individual", tools.initIterate, creator.Individual, toolbox.expr_init)
-    toolbox.register("population", tools.initRepeat, list, toolbox.individual)
+        # Transform a genome into a sequence of Actions
+        def decode(individual):
+            return [actionTable[actionId] for actionId in individual]
 
-    # Create the evaluation function
-    def evalSim(individual):
-        # Transform the AST into a sequence of Actions
-        individual = flatten_prog(individual)
+        # Transform a sequence of Actions into a genome
+        def encode(actions):
+            return types.Individual([action.id for action in actions][:maxLength])
 
-        # Simulate synth
-        result = simSynth(individual, mySynth, verbose=False, logOutput=logOutput)
+        # Start from random sequences of typical lengths
+        toolbox.register("individual", lineargenome.initLinear, types.Individual, genes, 2, min(20, maxLength), rng=rng)
+    elif genome == "tree":
+        # Primitive set and maximization problem types for these actions
+        types = context.gpTypes(myActions)
+        pset = types.pset
+        decode = flatten_prog
 
-        # Initialize tracking variables
-        penalties = 0
-        fitness = 0
-        fitnessProg = 0
-        maxCrossClassActionsExceeded = 0
+        # Transform a sequence of Actions into a chain of prog2 primitives
+        def encode(actions):
+            tempList = []
 
-        # Sum the constraint violations
-        penalties += result.wastedActions
+            for item in actions:
+                for terminal in pset.terminals[None]:
+                    if item == terminal.value:
+                        tempList.append(terminal)
+                        break
 
-        if not result.durabilityOk:
-           penalties += 1
+            myPrimitive = pset.primitives[None][0]
+            tempList = (len(tempList)-1) * [myPrimitive] + tempList
 
-        if not result.progressOk:
-            penalties += 1
+            return types.Individual(tempList)
 
-        if not result.cpOk:
-            penalties += 1
+        # Tell the GP to pull from the set of primitives when selecting genes
+        toolbox.register("expr_init", gp.genFull, pset=pset, min_=1, max_=2, rng=rng)
 
-        if not result.trickOk:
-            penalties += 1
+        # Structure initializers
+        toolbox.register("individual", tools.initIterate, types.Individual, toolbox.expr_init)
+    else:
+        raise ValueError("Unknown genome: %s" % genome)
+
+    toolbox.register("population", tools.initRepeat, list, toolbox.individual)
+
+    # Cache intermediate states so offspring resume from their parents' shared prefix
+    stateCache = None
+    if stateCacheSize:
+        stateCache = PrefixStateCache(mySynth, stateCacheSize)
+
+    # Remember the fitness of sequences that were already evaluated
+    fitnessCache = None
+    if fitnessCacheSize:
+        fitnessCache = FitnessCache(fitnessCacheSize, dummyAction.id)
 
-        maxCrossClassActionsExceeded = len(result.crossClassActionList) - maxCrossClassActions(mySynth.crafter.level)
+    maxCrossClass = maxCrossClassActions(mySynth.crafter.level)
+
+    def fitnessOf(quality, progress, penalties, crossClassCount):
+        maxCrossClassActionsExceeded = crossClassCount - maxCrossClass
         if maxCrossClassActionsExceeded > 0:
             penalties += maxCrossClassActionsExceeded
 
-        fitness += result.qualityState
-        fitness -= penaltyWeight * penalties
-        fitnessProg += result.progressState
+        fitness = quality - penaltyWeight * penalties
+        fitnessProg = progress
 
         return fitness, fitnessProg
 
+    # Create the evaluation function
+    def evalSim(individual):
+        # Transform the individual into a sequence of Actions
+        individual = decode(individual)
+
+        if fitnessCache is not None:
+            actionIds = [action.id for action in individual]
+            cached = fitnessCache.lookup(actionIds)
+            if cached is not None:
+                (quality, progress, penalties, crossClassCount), extraWasted = cached
+                return fitnessOf(quality, progress, penalties + extraWasted, crossClassCount)
+
+        # Simulate synth
+        quality, progress, penalties, crossClassCount, finishStep = simFitness(individual, mySynth, cache=stateCache, reportFinish=True)
+
+        if fitnessCache is not None:
+            fitnessCache.store(actionIds, (quality, progress, penalties, crossClassCount), finishStep)
+
+        return fitnessOf(quality, progress, penalties, crossClassCount)
+
+    # Simulate many sequences at once with the NumPy engine
+    def simulateBatchNumPy(sequences):
+        import batchsim
+        result = batchsim.simSynthBatch(sequences, mySynth)
+
+        # Sum the constraint violations
+        penalties = result.wastedActions.copy()
+        penalties += ~result.durabilityOk
+        penalties += ~result.progressOk
+        penalties += ~result.cpOk
+        penalties += ~result.trickOk
+
+        return [(float(result.qualityState[j]), float(result.progressState[j]), int(penalties[j]), int(result.crossClassCount[j]), None)
+                for j in range(len(sequences))]
+
+    # Simulate many sequences on the worker processes, sending only the action ids
+    def simulateBatchPool(sequences):
+        encoded = [array.array("B", [action.id for action in sequence]).tostring() for sequence in sequences]
+        chunkSize = max(1, len(encoded) // (4 * processes))
+        return evaluationPool.map(evaluationWorkerSimulate, encoded, chunkSize)
+
+    simulateBatch = simulateBatchPool if processes else simulateBatchNumPy
+
+    # Evaluate the whole population at once
+    def evalSimBatch(individuals):
+        sequences = [decode(ind) for ind in individuals]
+        components = len(sequences) * [None]
+
+        # Simulate each distinct sequence that is not cached once
+        misses = {}
+        for i, sequence in enumerate(sequences):
+            if fitnessCache is None:
+                misses[i] = [i]
+                continue
+
+            actionIds = [action.id for action in sequence]
+            cached = fitnessCache.lookup(actionIds)
+            if cached is not None:
+                (quality, progress, penalties, crossClassCount), extraWasted = cached
+                components[i] = (quality, progress, penalties + extraWasted, crossClassCount)
+            else:
+                misses.setdefault(fitnessCache.key(actionIds), []).append(i)
+
+        if misses:
+            groups = misses.values()
+            results = simulateBatch([sequences[group[0]] for group in groups])
+
+            for group, (quality, progress, penalties, crossClassCount, finishStep) in zip(groups, results):
+                simulated = (quality, progress, penalties, crossClassCount)
+                for i in group:
+                    components[i] = simulated
+                if fitnessCache is not None:
+                    fitnessCache.store([action.id for action in sequences[group[0]]], simulated, finishStep)
+
+        return [fitnessOf(*c) for c in components]
+
     # more GP setup
     toolbox.register("evaluate", evalSim)
-    toolbox.register("select", tools.selTournament, tournsize=7)
-    toolbox.register("mate", gp.cxOnePoint)
-    toolbox.register("expr_mut", gp.genRamped, min_=0, max_=2)
-    toolbox.register("mutate", gp.mutUniform, expr=toolbox.expr_mut)
+    if batchEvaluate or processes:
+        toolbox.register("evaluate_batch", evalSimBatch)
+    if parsimonySize:
+        toolbox.register("select", tools.selDoubleTournament, fitness_size=7, parsimony_size=parsimonySize, fitness_first=True, rng=rng)
+    else:
+        toolbox.register("select", tools.selTournament, tournsize=7, rng=rng)
+    if genome == "linear":
+        toolbox.register("mate", lineargenome.cxSegment, minLength=1, maxLength=maxLength, rng=rng)
+        toolbox.register("mutate", lineargenome.mutLinear, genes=genes, minLength=1, maxLength=maxLength, rng=rng)
+    else:
+        toolbox.register("mate", gp.cxOnePoint, rng=rng)
+        toolbox.register("expr_mut", gp.genRamped, min_=0, max_=2, rng=rng)
+        toolbox.register("mutate", gp.mutUniform, expr=toolbox.expr_mut, rng=rng)
+
+        # A tree of n actions has n - 1 prog2 nodes
+        toolbox.decorate("mate", gp.staticSizeLimit(2 * maxLength - 1, rng=rng))
+        toolbox.decorate("mutate", gp.staticSizeLimit(2 * maxLength - 1, rng=rng))
 
     # Set up initial guess in primitive form
     pop = toolbox.population(n=population)
     if not initialGuess is None:
-        tempList = []
-
-        for item in initialGuess:
-            if hasattr(item, "name"):
-                for terminal in pset.terminals[None]:
-                    if item == terminal.value:
-                        tempList.append(terminal)
-                        break
-
-        myPrimitive = pset.primitives[None][0]
-        tempList = (len(tempList)-1) * [myPrimitive] + tempList
-
         pop.pop(0)
-        iniGuess = creator.Individual(tempList)
+        iniGuess = encode([item for item in initialGuess if hasattr(item, "name")])
         pop.insert(0, iniGuess)
 
     hof = tools.HallOfFame(1)
@@ -1035,15 +2143,214 @@ def mainGP(mySynth, penaltyWeight, population=300, generations=100, seed=None, i
     stats.register("min", min)
     stats.register("max", max)
 
-    gpEvolution(pop, toolbox, 0.5, 0.2, generations, stats, halloffame=hof, verbose=verbose, logOutput=logOutput, progressFeedback=progressFeedback)
+    runInfo = {}
+
+    # Workers get the synth once and then only the sequences to evaluate
+    evaluationPool = None
+    if processes:
+        import multiprocessing
+        evaluationPool = multiprocessing.Pool(processes, initEvaluationWorker, (mySynth,))
+
+    # A sequence that passes all checks at max quality cannot be improved on
+    goal = None
+    if stopAtMaxQuality:
+        def goal(individual):
+            quality, progress, penalties, crossClassCount = simFitness(decode(individual), mySynth)
+            return penalties == 0 and crossClassCount <= maxCrossClass and quality >= mySynth.recipe.maxQuality
+
+    migrateEncoded = None
+    if migrate is not None:
+        migrateEncoded = lambda gen, population: migrate(gen, population, decode, encode)
+
+    try:
+        gpEvolution(pop, toolbox, 0.5, 0.2, generations, stats, halloffame=hof, verbose=verbose, logOutput=logOutput, progressFeedback=progressFeedback, rng=rng,
+                    fitnessCache=fitnessCache, migrate=migrateEncoded, stagnationLimit=stagnationGenerations, minStd=minFitnessStd, goal=goal,
+                    runInfo=runInfo, deadline=deadline, maxEvaluations=maxEvaluations)
+    finally:
+        if evaluationPool is not None:
+            evaluationPool.close()
+            evaluationPool.join()
+
+    if fitnessCache is not None:
+        logger.log("Fitness cache: %i lookups, hit ratio %.2f, %i hits on finished prefixes"
+                   % (fitnessCache.lookups, fitnessCache.hitRatio(), fitnessCache.finishedHits))
+
+    if stateCache is not None:
+        logger.log("State cache: %i lookups, hit ratio %.2f, %i steps saved, %i steps simulated"
+                   % (stateCache.lookups, stateCache.hitRatio(), stateCache.stepsSaved, stateCache.stepsSimulated))
 
     # Print Best Individual
     #==============================
-    best_ind = flatten_prog(hof[0])
+    best_ind = decode(hof[0])
     finalState = simSynth(best_ind, mySynth, logOutput=logOutput)
 
-    return best_ind, finalState, pop, hof, stats
+    return best_ind, finalState, pop, hof, stats, runInfo
+
+
+def encodeActionIds(actions):
+    """Pack a sequence of Actions into a string of action ids."""
+    return array.array("B", [action.id for action in actions]).tostring()
+
+def decodeActionIds(encoded):
+    """Unpack a string of action ids into a sequence of Actions."""
+    actionIds = array.array("B")
+    actionIds.fromstring(encoded)
+    return [actionTable[actionId] for actionId in actionIds]
+
+def islandWorker(connection, mySynth, penaltyWeight, migrationInterval, kwargs):
+    """Run the mainGP of one island in a worker process of mainGPIslands.
+
+    Every *migrationInterval* generations the island sends its population
+    as (packed action ids, fitness values) records over *connection* and
+    receives the (index, packed action ids, fitness values) records of the
+    individuals to replace.
+    """
+    def migrate(gen, population, decode, encode):
+        if gen % migrationInterval or gen == kwargs["generations"]:
+            return
+        connection.send(("migrate", [(encodeActionIds(decode(ind)), ind.fitness.values) for ind in population]))
+        for i, encoded, values in connection.recv():
+            immigrant = encode(decodeActionIds(encoded))
+            immigrant.fitness.values = values
+            population[i] = immigrant
+
+    def actionsOf(individual):
+        if isinstance(individual, gp.PrimitiveTree):
+            return flatten_prog(individual)
+        return [actionTable[actionId] for actionId in individual]
+
+    logOutput = StringIO.StringIO()
+    try:
+        best, finalState, pop, hof, stats, runInfo = mainGP(mySynth, penaltyWeight, logOutput=logOutput, migrate=migrate, **kwargs)
+        connection.send(("done", [(encodeActionIds(best), hof[0].fitness.values)],
+                         [(encodeActionIds(actionsOf(ind)), ind.fitness.values) for ind in pop],
+                         logOutput.getvalue(), runInfo))
+    except Exception:
+        connection.send(("error", traceback.format_exc()))
+    finally:
+        connection.close()
+
+def mainGPIslands(mySynth, penaltyWeight, islands=4, population=300, generations=100, migrationInterval=10, migrants=5, seed=None,
+                  initialGuess=None, verbose=False, logOutput=None, context=None, **kwargs):
+    """Run mainGP on several islands in separate processes.
+
+    Each island evolves its own population of *population* individuals from
+    its own seed. Every *migrationInterval* generations the *migrants* best
+    individuals of each island replace the worst individuals of the next one
+    in a ring, by :func:`deap.tools.migRing` on copies of the populations
+    that the islands send as packed action id sequences. The remaining
+    keyword arguments are passed on to mainGP, except for *processes*: the
+    islands already run in processes of their own, which cannot start
+    evaluation pools.
+
+    :returns: A (best sequence, its final State, final populations of all
+              islands, global hall of fame, statistics of the final
+              populations, run info) tuple. Individuals are linear genomes.
+              The run info holds the run info of each island as "islands",
+              the most generations run by an island as "generations" and
+              the evaluations of all islands as "evaluations" and
+              "evaluationsPerSecond".
+    """
+    import multiprocessing
+
+    if kwargs.get("processes") is not None:
+        raise ValueError("Islands cannot evaluate with processes, they run in processes of their own")
+
+    logger = Logger(logOutput)
+
+    # Do this be able to print the seed used
+    if seed is None:
+        seed = random.randint(0, 19770216)
+    rng = random.Random(seed)
+    seeds = [rng.randint(0, 19770216) for i in range(islands)]
+
+    if context is None:
+        context = defaultSolverContext
+    types = context.linearTypes()
+
+    def decode(individual):
+        return [actionTable[actionId] for actionId in individual]
+
+    def toIndividual(record):
+        encoded, values = record
+        individual = types.Individual([action.id for action in decodeActionIds(encoded)])
+        individual.fitness.values = values
+        return individual
+
+    # Only the first island starts from the initial guess
+    connections = []
+    workers = []
+    for i in range(islands):
+        parentConnection, childConnection = multiprocessing.Pipe()
+        islandKwargs = dict(kwargs, population=population, generations=generations, seed=seeds[i], verbose=verbose,
+                            initialGuess=initialGuess if i == 0 else None)
+        worker = multiprocessing.Process(target=islandWorker, args=(childConnection, mySynth, penaltyWeight, migrationInterval, islandKwargs))
+        worker.daemon = True
+        worker.start()
+        childConnection.close()
+        connections.append(parentConnection)
+        workers.append(worker)
+
+    results = islands * [None]
+    try:
+        # Each round every island that is still running either asks to migrate or finishes
+        running = range(islands)
+        while running:
+            messages = [connections[i].recv() for i in running]
+            for i, message in zip(running, messages):
+                if message[0] == "error":
+                    raise RuntimeError("Island %i failed:\n%s" % (i, message[1]))
+
+            migrating = [i for i, message in zip(running, messages) if message[0] == "migrate"]
+            for i, message in zip(running, messages):
+                if message[0] == "done":
+                    results[i] = message[1:]
+
+            populations = [[toIndividual(record) for record in message[1]] for message in messages if message[0] == "migrate"]
+            originals = [list(pop) for pop in populations]
+            if len(populations) > 1:
+                tools.migRing(populations, migrants, tools.selBest, replacement=tools.selWorst)
+
+            for i, pop, original in zip(migrating, populations, originals):
+                changes = [(j, encodeActionIds(decode(ind)), ind.fitness.values)
+                           for j, (ind, before) in enumerate(zip(pop, original)) if ind is not before]
+                connections[i].send(changes)
+
+            running = migrating
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+    # Global hall of fame and final populations of all islands
+    hof = tools.HallOfFame(islands)
+    pop = []
+    runInfo = {"islands": []}
+    for i, (hofRecords, popRecords, islandLog, islandRunInfo) in enumerate(results):
+        if verbose:
+            logger.log("Island %i, seed %i:" % (i, seeds[i]))
+            logger.out.write(islandLog)
+        hof.update([toIndividual(record) for record in hofRecords])
+        pop.extend(toIndividual(record) for record in popRecords)
+        runInfo["islands"].append(islandRunInfo)
+    runInfo["generations"] = max(info["generations"] for info in runInfo["islands"])
+    runInfo["evaluations"] = sum(info["evaluations"] for info in runInfo["islands"])
+    runInfo["evaluationsPerSecond"] = sum(info["evaluationsPerSecond"] for info in runInfo["islands"])
+
+    stats = tools.Statistics(lambda ind: ind.fitness.values)
+    stats.register("avg", tools.mean)
+    stats.register("std", tools.std)
+    stats.register("min", min)
+    stats.register("max", max)
+    stats.update(pop)
+
+    # Print Best Individual
+    #==============================
+    best_ind = decode(hof[0])
+    finalState = simSynth(best_ind, mySynth, logOutput=logOutput)
 
+    return best_ind, finalState, pop, hof, stats, runInfo
 
 def mainRecipeWrapper():
     # Recipe Stuff
@@ -0,0 +1,182 @@
+"""Statistics helpers for Monte Carlo simulation results."""
+
+import math
+
+
+def normalQuantile(p):
+    """Inverse of the standard normal cumulative distribution function."""
+    if not 0 < p < 1:
+        raise ValueError("p must be between 0 and 1")
+
+    lo, hi = -10.0, 10.0
+    for i in range(100):
+        mid = (lo + hi) / 2
+        if 0.5 * (1 + math.erf(mid / math.sqrt(2))) < p:
+            lo = mid
+        else:
+            hi = mid
+    return (lo + hi) / 2
+
+
+def percentile(sortedValues, p):
+    """Percentile p (0-100) of a sorted sequence, interpolating linearly between ranks."""
+    if not len(sortedValues):
+        raise ValueError("percentile of an empty sequence")
+
+    rank = (len(sortedValues) - 1) * p / 100.0
+    lower = int(math.floor(rank))
+    upper = min(lower + 1, len(sortedValues) - 1)
+    fraction = rank - lower
+    return sortedValues[lower] + (sortedValues[upper] - sortedValues[lower]) * fraction
+
+
+def confidenceInterval(mean, std, n, confidence):
+    """Normal approximation confidence interval for a mean of n samples."""
+    if n < 2:
+        return mean, mean
+    halfWidth = normalQuantile((1 + confidence) / 2.0) * std / math.sqrt(n)
+    return mean - halfWidth, mean + halfWidth
+
+
+class QuantileSketch(object):
+    """Mergeable quantile sketch with memory logarithmic in the number of values.
+
+    Values are kept in levels where an item of level i stands for 2**i of the
+    values added. When a level holds more than *k* items it is sorted and
+    every other item is promoted to the next level. Until the first such
+    compaction the quantiles are exact.
+
+    After compactions the accuracy holds for moderate percentiles only. With
+    the default *k* and 100000 normal values the 5th and 95th percentiles
+    are close, but the 1st and 99th can be off by 0.15 standard
+    deviations, because few items of the top levels are left in the tails.
+    """
+    def __init__(self, k=256):
+        self.k = k
+        self.levels = [[]]
+        self.n = 0
+        self.compactions = 0
+
+    def add(self, x):
+        self.levels[0].append(x)
+        self.n += 1
+        if len(self.levels[0]) > self.k:
+            self._compact()
+
+    def merge(self, other):
+        for i, level in enumerate(other.levels):
+            if i >= len(self.levels):
+                self.levels.append([])
+            self.levels[i].extend(level)
+        self.n += other.n
+        self._compact()
+
+    def quantile(self, p):
+        """Percentile p (0-100) of the values added."""
+        if len(self.levels) == 1:
+            return percentile(sorted(self.levels[0]), p)
+
+        weighted = sorted((x, 2**i) for i, level in enumerate(self.levels) for x in level)
+        target = sum(w for x, w in weighted) * p / 100.0
+        cumulative = 0
+        for x, w in weighted:
+            cumulative += w
+            if cumulative >= target:
+                return x
+        return weighted[-1][0]
+
+    def _compact(self):
+        i = 0
+        while i < len(self.levels):
+            level = self.levels[i]
+            if len(level) > self.k:
+                level.sort()
+                # Keep an odd item out and alternate which half of each pair is promoted
+                kept = level[-1:] if len(level) % 2 else []
+                paired = level[:len(level) - len(kept)]
+                promoted = paired[self.compactions % 2::2]
+                self.compactions += 1
+                self.levels[i] = kept
+                if i + 1 == len(self.levels):
+                    self.levels.append([])
+                self.levels[i + 1].extend(promoted)
+            i += 1
+
+
+class RunningStats(object):
+    """Streaming count, mean, variance, min and max of a series of values.
+
+    Uses Welford's update for single values and Chan's formula to combine
+    partial results, so merged accumulators give the same result as a single
+    one that saw all the values. An optional :class:`QuantileSketch` tracks
+    percentiles.
+    """
+    def __init__(self, sketch=False):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.sketch = QuantileSketch() if sketch else None
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+        if self.minimum is None or x < self.minimum:
+            self.minimum = x
+        if self.maximum is None or x > self.maximum:
+            self.maximum = x
+        if self.sketch is not None:
+            self.sketch.add(x)
+
+    def addSummary(self, n, mean, m2, minimum, maximum):
+        """Fold in the summary of n values computed elsewhere."""
+        if n == 0:
+            return
+        if self.n == 0:
+            self.n, self.mean, self.m2, self.minimum, self.maximum = n, float(mean), float(m2), minimum, maximum
+            return
+
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta**2 * self.n * n / total
+        self.n = total
+        self.minimum = min(self.minimum, minimum)
+        self.maximum = max(self.maximum, maximum)
+
+    def merge(self, other):
+        self.addSummary(other.n, other.mean, other.m2, other.minimum, other.maximum)
+        if self.sketch is not None and other.sketch is not None:
+            self.sketch.merge(other.sketch)
+
+    def variance(self):
+        if self.n < 2:
+            return 0.0
+        return self.m2 / (self.n - 1)
+
+    def std(self):
+        return math.sqrt(self.variance())
+
+    def stdError(self):
+        if self.n == 0:
+            return 0.0
+        return self.std() / math.sqrt(self.n)
+
+    def confidenceInterval(self, confidence):
+        return confidenceInterval(self.mean, self.std(), self.n, confidence)
+
+    def quantile(self, p):
+        if self.sketch is None:
+            raise ValueError("Quantiles were not tracked for these statistics")
+        return self.sketch.quantile(p)
+
+    def toDict(self):
+        return {
+            "mean": self.mean,
+            "std": self.std(),
+            "min": self.minimum,
+            "max": self.maximum,
+        }
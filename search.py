@@ -0,0 +1,570 @@
+"""Deterministic search for the best sequence of actions.
+
+Sequences are built one action at a time with the expected value simulation
+of main.simFitness, resuming each step from the FitnessState of the parent
+sequence. Only the best partial sequences of each length are kept, in a
+beam. A partial sequence is pruned when it can no longer finish the synth,
+or when even an upper bound on the quality it could still gain cannot lift
+it above the best finished sequence found so far.
+"""
+
+import array
+import math
+import struct
+import threading
+import time
+
+import numpy as np
+from deap import tools
+
+import main
+from util import NullLogOutput
+
+
+class QualityBound(object):
+    """Admissible upper bounds on what a synth can still achieve from a state.
+
+    Every bound assumes the best case for the crafter's actions: each step
+    uses the best touch with Great Strides, Innovation, the best level
+    difference and Steady Hand II, Inner Quiet gains a full stack per touch,
+    and every CP that is not spent on touches restores durability at the
+    best rate available. Conditions are bounded by their largest expected
+    multiplier.
+    """
+    def __init__(self, synth):
+        self.synth = synth
+        actions = [action for action in synth.crafter.actions if action.id != main.dummyAction.id]
+        actionIds = set(action.id for action in actions)
+        gainTables = synth.gainTables()
+
+        if main.steadyHand2.id in actionIds:
+            successBonus = 0.3
+        elif main.steadyHand.id in actionIds:
+            successBonus = 0.2
+        else:
+            successBonus = 0
+        def success(action):
+            return min(action.successProbability + successBonus, 1)
+
+        baseLevelDifference = synth.crafter.level - synth.recipe.level
+        self.levelDifferences = [baseLevelDifference]
+        if main.ingenuity.id in actionIds:
+            self.levelDifferences.append(0)
+        if main.ingenuity2.id in actionIds:
+            self.levelDifferences.append(3)
+        self.innovations = (False, True) if main.innovation.id in actionIds else (False,)
+        self.innerQuiet = main.innerQuiet.id in actionIds
+
+        # Quality multiplier of the best touch, Byregot's Blessing grows with IQ
+        touches = [action for action in actions if action.qualityIncreaseMultiplier > 0]
+        self.touchMultiplier = max([action.qualityIncreaseMultiplier * success(action) for action in touches
+                                    if action.id != main.byregotsBlessing.id] or [0])
+        self.byregotsMultiplier = 0
+        if main.byregotsBlessing.id in actionIds:
+            self.byregotsMultiplier = main.byregotsBlessing.qualityIncreaseMultiplier * success(main.byregotsBlessing)
+        self.touchCp = min([action.cpCost for action in touches] or [0])
+        self.multiplier = 2 if main.greatStrides.id in actionIds else 1
+        self.conditionMultiplier = 1
+        if synth.useConditions:
+            # After the first step Good and Excellent are at most this likely
+            self.conditionMultiplier = 1 + 0.5 * 0.23 + 3 * 0.01
+
+        # Progress of the best synthesis
+        self.progressGain = 0
+        for action in actions:
+            if action.progressIncreaseMultiplier <= 0:
+                continue
+            if action.id == main.flawlessSynthesis.id:
+                gain = 40 * success(action)
+            elif action.id == main.pieceByPiece.id:
+                continue
+            else:
+                gain = action.progressIncreaseMultiplier * success(action) * max(gainTables.progress[ld] for ld in self.levelDifferences)
+            self.progressGain = max(self.progressGain, gain)
+        self.pieceByPiece = success(main.pieceByPiece) if main.pieceByPiece.id in actionIds else 0
+
+        # Cheapest durability cost of a step that makes progress or quality
+        self.durabilityCost = min(action.durabilityCost for action in actions
+                                  if action.qualityIncreaseMultiplier > 0 or action.progressIncreaseMultiplier > 0)
+        if main.wasteNot.id in actionIds or main.wasteNot2.id in actionIds:
+            self.durabilityCost *= 0.5
+
+        # Best durability restored per CP
+        self.restorePerCp = 0
+        if main.mastersMend.id in actionIds:
+            self.restorePerCp = max(self.restorePerCp, 30.0 / main.mastersMend.cpCost)
+        if main.mastersMend2.id in actionIds:
+            self.restorePerCp = max(self.restorePerCp, 60.0 / main.mastersMend2.cpCost)
+        if main.manipulation.id in actionIds:
+            self.restorePerCp = max(self.restorePerCp, 10.0 * main.manipulation.activeTurns / main.manipulation.cpCost)
+
+        # CP that can be gained once and per step. Comfort Zone gains at most
+        # its full duration once and its net gain per step of a cast after
+        # that. Rumination gains at most 60 once and then no more than 4 per
+        # step of casting Inner Quiet, touching and casting Rumination again.
+        self.cpOnce = 0
+        self.cpPerStep = 0
+        if main.comfortZone.id in actionIds:
+            self.cpOnce += 8 * main.comfortZone.activeTurns
+            self.cpPerStep += max(8.0 * main.comfortZone.activeTurns - main.comfortZone.cpCost, 0) / (main.comfortZone.activeTurns + 1)
+        if main.rumination.id in actionIds:
+            self.cpOnce += 60
+            self.cpPerStep += 4
+        self.tricks = main.tricksOfTheTrade.id in actionIds
+
+        self.qualitySums = [0.0]
+
+    def touchGain(self, iqStacks):
+        """Largest expected quality gain of a touch at a number of IQ stacks."""
+        baseQuality = max(self.synth.gainTables().baseQuality(ld, iqStacks, innovation)
+                          for ld in self.levelDifferences for innovation in self.innovations)
+        multiplier = max(self.touchMultiplier, self.byregotsMultiplier * (1 + 0.2 * iqStacks))
+        return self.multiplier * self.conditionMultiplier * multiplier * baseQuality
+
+    def qualitySum(self, iqStacks, touches):
+        """Sum of the touch gains of *touches* touches starting at iqStacks."""
+        while len(self.qualitySums) <= iqStacks + touches:
+            stacks = len(self.qualitySums) - 1
+            self.qualitySums.append(self.qualitySums[-1] + self.touchGain(stacks))
+        return self.qualitySums[iqStacks + touches] - self.qualitySums[iqStacks]
+
+    def progressSteps(self, state):
+        """Fewest steps that can finish the progress from a state, or None if
+        it cannot be finished."""
+        progressLeft = float(self.synth.recipe.difficulty - state.progressState)
+        if progressLeft <= 0:
+            return 0
+        stepGain = max(self.progressGain, self.pieceByPiece * progressLeft / 3)
+        if stepGain <= 0:
+            return None
+        return int(math.ceil(progressLeft / stepGain - 1e-9))
+
+    def remainingQuality(self, state, steps):
+        """Bound the expected quality that can still be gained in *steps*
+        steps from a :class:`main.FitnessState` while finishing the synth.
+
+        :returns: The bound, or None if the synth cannot be finished.
+        """
+        synth = self.synth
+        if state.durabilityState <= 0:
+            return None
+
+        progressSteps = self.progressSteps(state)
+        if progressSteps is None:
+            return None
+
+        cp = state.cpState + self.cpOnce + self.cpPerStep * steps
+        if self.tricks:
+            cp += 20 * max(synth.maxTrickUses - state.trickUses, 0)
+        cp = max(cp, 0)
+
+        # Every touch and synthesis needs durability, which CP can restore
+        durability = state.durabilityState + self.restorePerCp * cp
+        if progressSteps * self.durabilityCost > durability + 1e-9 or progressSteps > steps:
+            return None
+        touches = min(steps - progressSteps,
+                      int(math.floor((durability - progressSteps * self.durabilityCost) / (self.durabilityCost + self.restorePerCp * self.touchCp) + 1e-9)))
+        if self.touchCp > 0:
+            touches = min(touches, int(math.floor(cp / self.touchCp + 1e-9)))
+        if touches <= 0:
+            return 0.0
+
+        stateMultiplier = 1
+        if synth.useConditions:
+            stateMultiplier = max(1, (state.ppNormal + 1.5 * state.ppGood + 4 * state.ppExcellent + 0.5 * state.ppPoor) / self.conditionMultiplier)
+
+        if state.iqStacks is None and not self.innerQuiet:
+            return stateMultiplier * touches * self.touchGain(0)
+        iqStacks = int(math.ceil(state.iqStacks)) if state.iqStacks is not None else 0
+        return stateMultiplier * self.qualitySum(iqStacks, touches)
+
+
+class _StateGroup(object):
+    """Values of the states of one group of a :class:`TranspositionTable`,
+    one row per state, and whether each state is still undominated."""
+    def __init__(self, nValues):
+        self.values = np.empty((16, nValues))
+        self.current = np.zeros(16, dtype=bool)
+        self.n = 0
+
+    def append(self, values):
+        if self.n == len(self.values):
+            self.values = np.concatenate((self.values, np.empty_like(self.values)))
+            self.current = np.concatenate((self.current, np.zeros_like(self.current)))
+        self.values[self.n] = values
+        self.current[self.n] = True
+        self.n += 1
+        return self.n - 1
+
+
+class TranspositionTable(object):
+    """Table of the simulator states reached by a search, to drop states that
+    cannot do better than one already reached.
+
+    States are grouped by a packed encoding of what must match exactly for
+    one state to stand in for another: the condition probabilities, the
+    cross class actions used, which effects are active, the Ingenuity
+    timers, which can lower the level difference, and IQ stacks above 10,
+    after which Rumination restores less CP. Within a group a state
+    dominates another if it took no more steps, wasted no more actions,
+    used no more tricks and has at least the quality, durability, CP,
+    progress, IQ stacks and turns left on each effect. Identical states
+    dominate each other, so transpositions are dropped too. A search that
+    gives up on a state should :meth:`discard` it, so that it drops no
+    state the search still has to explore.
+
+    The table works on :class:`main.FitnessState` but any search that keeps
+    such states, by :func:`main.simFitness` from a start state, can use it.
+    """
+    def __init__(self, synth):
+        self.synth = synth
+        self.rumination = any(action.id == main.rumination.id for action in synth.crafter.actions)
+        self.exactSlots = (main.ingenuity.effectSlot, main.ingenuity2.effectSlot)
+        self.groups = {}
+
+        # Statistics
+        self.lookups = 0
+        self.dominated = 0
+        self.replaced = 0
+
+    def __len__(self):
+        return sum(int(group.current[:group.n].sum()) for group in self.groups.values())
+
+    def key(self, state):
+        """Packed encoding of the part of a state that must match exactly."""
+        turnsLeft = [max(expiry - state.liveSteps, 0) for expiry in state.expiry]
+        activeEffects = 0
+        for slot, turns in enumerate(turnsLeft):
+            if turns:
+                activeEffects |= 1 << slot
+        iqStacks = state.iqStacks
+        if iqStacks is None or not (self.rumination and iqStacks > 10):
+            iqStacks = -1.0
+        return (struct.pack("<4dId?", state.ppGood, state.ppExcellent, state.ppPoor, state.ppNormal, activeEffects, iqStacks,
+                            state.iqStacks is None)
+                + array.array("B", [turnsLeft[slot] for slot in self.exactSlots]).tostring()
+                + array.array("B", sorted(state.crossClassIds)).tostring())
+
+    def values(self, state, steps):
+        """Values of a state that are better when larger."""
+        turnsLeft = tuple(max(expiry - state.liveSteps, 0) for expiry in state.expiry)
+        iqStacks = state.iqStacks if state.iqStacks is not None else -1
+        return (state.qualityState, state.durabilityState, state.cpState, state.progressState, iqStacks,
+                -state.trickUses, -state.wastedActions, -steps) + turnsLeft
+
+    def insert(self, state, steps):
+        """Add a state reached after *steps* actions unless a state in the
+        table dominates it. States it dominates are removed.
+
+        :returns: The entry of the state, for :meth:`isCurrent`, or None if
+                  the state is dominated.
+        """
+        self.lookups += 1
+        values = np.array(self.values(state, steps), dtype=float)
+        key = self.key(state)
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = _StateGroup(len(values))
+
+        if group.n:
+            others = group.values[:group.n]
+            current = group.current[:group.n]
+            if (current & (others >= values).all(axis=1)).any():
+                self.dominated += 1
+                return None
+            worse = current & (others <= values).all(axis=1)
+            self.replaced += int(worse.sum())
+            current[worse] = False
+
+        return group, group.append(values)
+
+    def isCurrent(self, entry):
+        """Whether no state dominating that of an entry was inserted since."""
+        group, index = entry
+        return bool(group.current[index])
+
+    def discard(self, entry):
+        """Stop an entry from dominating later states, for states that the
+        search gave up on."""
+        group, index = entry
+        group.current[index] = False
+
+
+def selectBeam(children, beamWidth):
+    """Keep the best partial sequences of a depth.
+
+    Partial sequences that still need more steps to finish the progress have
+    less quality, so they are ranked by score and then progress only against
+    those that need as many steps. The beam takes the best of each of these
+    groups in turn.
+
+    :param children: List of (score, progress, progress steps, sequence,
+                     state) tuples.
+    :returns: A list of (sequence, state) tuples.
+    """
+    groups = {}
+    for child in children:
+        groups.setdefault(child[2], []).append(child)
+
+    ranked = []
+    for progressSteps, group in groups.items():
+        group.sort(key=lambda child: (child[0], child[1]), reverse=True)
+        ranked.extend((rank, progressSteps, child) for rank, child in enumerate(group))
+    ranked.sort(key=lambda item: (item[0], item[1]))
+
+    return [(child[3], child[4]) for rank, progressSteps, child in ranked[:beamWidth]]
+
+
+def beamSearch(mySynth, penaltyWeight, beamWidth=100, maxLength=50, startState=None, verbose=False, logOutput=None,
+               progressFeedback=None, timeLimit=None, context=None, transpositions=True):
+    """Search for the best sequence of actions for a synth with a beam search.
+
+    Starting from the empty sequence, or from *startState*, every partial
+    sequence of the beam is extended by each of the crafter's actions.
+    Extensions that waste the action, use too many cross class actions, run
+    out of CP or tricks, cannot finish the synth within *maxLength* actions
+    or cannot beat the best finished sequence according to
+    :class:`QualityBound` are dropped. Extensions that finish the synth are
+    kept as results. The others are scored by the expected quality they
+    would have after their best next touch, and the *beamWidth* best of
+    them, see :func:`selectBeam`, form the next beam. With *transpositions*
+    extensions that reach a state dominated by one reached before, see
+    :class:`TranspositionTable`, are dropped as well.
+
+    :returns: A (best sequence, its final State, best finished sequences,
+              hall of fame, statistics, run info) tuple like :func:`main.mainGP`.
+              Individuals are linear genomes of action ids.
+    """
+    logger = main.Logger(logOutput)
+    startTime = time.time()
+    deadline = None
+    if timeLimit is not None:
+        deadline = startTime + timeLimit
+
+    if context is None:
+        context = main.defaultSolverContext
+    types = context.linearTypes()
+
+    actions = [action for action in mySynth.crafter.actions if action.id != main.dummyAction.id]
+    maxCrossClass = main.maxCrossClassActions(mySynth.crafter.level)
+    bound = QualityBound(mySynth)
+    touches = [action for action in actions if action.qualityIncreaseMultiplier > 0]
+    difficulty = mySynth.recipe.difficulty
+    table = TranspositionTable(mySynth) if transpositions else None
+
+    def toIndividual(sequence, quality, progress, penalties, crossClassCount):
+        individual = types.Individual([action.id for action in sequence])
+        maxCrossClassActionsExceeded = crossClassCount - maxCrossClass
+        if maxCrossClassActionsExceeded > 0:
+            penalties += maxCrossClassActionsExceeded
+        individual.fitness.values = (quality - penaltyWeight * penalties, progress)
+        return individual
+
+    # Sequences that finished the synth
+    finished = tools.HallOfFame(beamWidth)
+    incumbent = None
+
+    initialState = startState
+    if initialState is None:
+        initialState = main.startFitnessState(mySynth)
+    beam = [((), initialState)]
+
+    evaluations = 0
+    pruned = 0
+    depth = 0
+    stopReason = "exhausted"
+    while beam:
+        if depth == maxLength:
+            stopReason = "maxLength"
+            break
+        depth += 1
+        stepsLeft = maxLength - depth
+
+        children = []
+        finishedHere = []
+        for sequence, state in beam:
+            for action in actions:
+                quality, progress, penalties, crossClassCount, childState = main.simFitness([action], mySynth, startState=state, reportState=True)
+                evaluations += 1
+
+                # Never waste an action or break a limit that cannot be recovered
+                if (childState.wastedActions > state.wastedActions or crossClassCount > maxCrossClass or childState.cpState < 0
+                        or childState.trickUses > mySynth.maxTrickUses):
+                    pruned += 1
+                    continue
+
+                childSequence = sequence + (action,)
+                if progress >= difficulty:
+                    finishedHere.append(toIndividual(childSequence, quality, progress, penalties, crossClassCount))
+                    if penalties == 0 and (incumbent is None or quality > incumbent):
+                        incumbent = quality
+                    continue
+
+                remaining = bound.remainingQuality(childState, stepsLeft)
+                if remaining is None or (incumbent is not None and quality + remaining <= incumbent):
+                    pruned += 1
+                    continue
+
+                entry = None
+                if table is not None:
+                    entry = table.insert(childState, len(childSequence))
+                    if entry is None:
+                        continue
+
+                # Rank by the quality after the best touch, which credits buffs and IQ stacks
+                score = max([main.simFitness([touch], mySynth, startState=childState)[0] for touch in touches] or [quality])
+                children.append((score, progress, bound.progressSteps(childState), childSequence, childState, entry))
+        finished.update(finishedHere)
+
+        # Drop the states that a later one of this depth dominates
+        children = [child for child in children if child[5] is None or table.isCurrent(child[5])]
+        beam = selectBeam(children, beamWidth)
+
+        # States cut by the beam are never expanded, so they must not drop later ones
+        if table is not None:
+            kept = set(id(sequence) for sequence, state in beam)
+            for child in children:
+                if id(child[3]) not in kept:
+                    table.discard(child[5])
+
+        if verbose:
+            logger.log("Depth %i: %i partial sequences, %i pruned, best finished quality %s"
+                       % (depth, len(children), pruned, "%.1f" % incumbent if incumbent is not None else "-"))
+
+        if progressFeedback:
+            if not progressFeedback(depth):
+                logger.log("Stop requested.")
+                stopReason = "stopped"
+                break
+
+        if deadline is not None and time.time() > deadline:
+            logger.log("Time budget used.")
+            stopReason = "time"
+            break
+
+    # Without a finished sequence settle for the best partial one
+    if not len(finished):
+        for sequence, state in beam:
+            quality, progress, penalties, crossClassCount = main.simFitness([], mySynth, startState=state)
+            finished.update([toIndividual(sequence, quality, progress, penalties, crossClassCount)])
+    if not len(finished):
+        raise ValueError("No sequence of the crafter's actions can be simulated")
+
+    hof = tools.HallOfFame(1)
+    pop = list(finished)
+    hof.update(pop)
+
+    stats = tools.Statistics(lambda ind: ind.fitness.values)
+    stats.register("avg", tools.mean)
+    stats.register("std", tools.std)
+    stats.register("min", min)
+    stats.register("max", max)
+    stats.update(pop)
+
+    seconds = time.time() - startTime
+    runInfo = {
+        "generations": depth,
+        "stopReason": stopReason,
+        "evaluations": evaluations,
+        "pruned": pruned,
+        "dominated": table.dominated + table.replaced if table is not None else 0,
+        "seconds": seconds,
+        "evaluationsPerSecond": evaluations / seconds if seconds > 0 else 0.0,
+    }
+
+    # Print Best Individual
+    #==============================
+    best_ind = [main.actionTable[actionId] for actionId in hof[0]]
+    finalState = main.simSynth(best_ind, mySynth, logOutput=logOutput, startState=startState)
+
+    return best_ind, finalState, pop, hof, stats, runInfo
+
+
+class Replanner(object):
+    """Re-optimizes the rest of a synth in progress within a time budget.
+
+    A replanner is created once per synth and kept warm between calls: it
+    holds the solver context with the solve types already built, the synth
+    with its gain tables filled by earlier searches, and the time its last
+    search took per unit of beam width. Each call to :meth:`replan` runs
+    :func:`beamSearch` from a live state with the widest beam that this rate
+    predicts to fit the budget, *minBeamWidth* on the first call, and then
+    doubles the width while the budget leaves time for another search.
+    """
+    def __init__(self, mySynth, penaltyWeight, maxLength=50, minBeamWidth=8, maxBeamWidth=256, context=None):
+        if context is None:
+            context = main.defaultSolverContext
+        self.synth = mySynth
+        self.penaltyWeight = penaltyWeight
+        self.maxLength = maxLength
+        self.minBeamWidth = minBeamWidth
+        self.maxBeamWidth = maxBeamWidth
+        self.context = context
+        context.linearTypes()
+        # Seconds per unit of beam width of the last search that ran to the end
+        self.secondsPerWidth = None
+        # Guards secondsPerWidth, replans themselves run concurrently
+        self.lock = threading.Lock()
+
+    def startWidth(self, timeLimit):
+        """Widest beam, *minBeamWidth* doubled a number of times, that the
+        last measured rate predicts to fit into *timeLimit* seconds."""
+        with self.lock:
+            secondsPerWidth = self.secondsPerWidth
+        beamWidth = self.minBeamWidth
+        if secondsPerWidth is not None:
+            while 2 * beamWidth <= self.maxBeamWidth and 2 * beamWidth * secondsPerWidth <= timeLimit:
+                beamWidth *= 2
+        return beamWidth
+
+    def replan(self, startState, timeLimit=0.2, logOutput=None):
+        """Find the best remaining sequence from *startState*, for example
+        from :func:`main.liveFitnessState`.
+
+        Every search stops after the depth at which *timeLimit* seconds have
+        passed since the call, keeping the best sequence found so far, or the
+        best partial one if none finished the synth. Searches after the first
+        are only started if one taking twice as long as the last one still
+        fits. Concurrent calls do not wait for each other: searches only read
+        the shared synth and context. The final state of the result is logged
+        to *logOutput*, nowhere if it is None.
+
+        :returns: The result tuple of the best search, see
+                  :func:`beamSearch`. Its run info also gives the beamWidth
+                  of that search and the seconds and evaluations of all
+                  searches.
+        """
+        if logOutput is None:
+            logOutput = NullLogOutput()
+
+        startTime = time.time()
+        result = None
+        evaluations = 0
+        beamWidth = self.startWidth(timeLimit)
+        while beamWidth <= self.maxBeamWidth:
+            searchStart = time.time()
+            candidate = beamSearch(self.synth, self.penaltyWeight, beamWidth=beamWidth, maxLength=self.maxLength,
+                                   startState=startState, logOutput=NullLogOutput(),
+                                   timeLimit=startTime + timeLimit - searchStart, context=self.context)
+            candidate[5]["beamWidth"] = beamWidth
+            evaluations += candidate[5]["evaluations"]
+            if result is None or candidate[3][0].fitness > result[3][0].fitness:
+                result = candidate
+
+            now = time.time()
+            if candidate[5]["stopReason"] == "time":
+                break
+            with self.lock:
+                self.secondsPerWidth = (now - searchStart) / beamWidth
+            if now + 2 * (now - searchStart) > startTime + timeLimit:
+                break
+            beamWidth *= 2
+
+        best_ind, finalState, pop, hof, stats, runInfo = result
+        # Log the final state of the chosen sequence
+        finalState = main.simSynth(best_ind, self.synth, logOutput=logOutput, startState=startState)
+        seconds = time.time() - startTime
+        runInfo["evaluations"] = evaluations
+        runInfo["seconds"] = seconds
+        runInfo["evaluationsPerSecond"] = evaluations / seconds if seconds > 0 else 0.0
+        return best_ind, finalState, pop, hof, stats, runInfo
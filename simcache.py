@@ -0,0 +1,222 @@
+"""Bounded caches of simulator states and fitness values keyed by action sequence."""
+
+import bisect
+
+
+class _TrieNode(object):
+    __slots__ = ("parent", "key", "children", "state", "lastUsed")
+
+    def __init__(self, parent=None, key=None):
+        self.parent = parent
+        self.key = key
+        self.children = {}
+        self.state = None
+        self.lastUsed = 0
+
+
+class PrefixStateCache(object):
+    """Prefix trie of simulator states with least recently used eviction.
+
+    Each node of the trie is an action id and may hold the simulator state
+    reached after the sequence of actions leading to it. Simulating a sequence
+    can then resume from the longest prefix that has a cached state instead
+    of step 0. At most *maxStates* states are kept; when the cache is full the
+    least recently used quarter of them is evicted. A cache is only valid for
+    the Synth it was created for.
+    """
+    def __init__(self, synth, maxStates=100000):
+        self.synth = synth
+        self.maxStates = maxStates
+        self.root = _TrieNode()
+        self.cached = set()
+        self.clock = 0
+
+        # Statistics
+        self.lookups = 0
+        self.hits = 0
+        self.stepsSaved = 0
+        self.stepsSimulated = 0
+
+    def __len__(self):
+        return len(self.cached)
+
+    def lookup(self, actionIds):
+        """Find the longest cached prefix of a sequence of action ids.
+
+        :returns: A (node, depth, state) tuple where node is the trie node of
+                  the prefix, depth its length and state the cached state, or
+                  (root, 0, None) if no prefix is cached.
+        """
+        self.lookups += 1
+        self.clock += 1
+        node = self.root
+        best = (self.root, 0, None)
+        for depth, actionId in enumerate(actionIds):
+            node = node.children.get(actionId)
+            if node is None:
+                break
+            if node.state is not None:
+                best = (node, depth + 1, node.state)
+
+        bestNode, bestDepth, _ = best
+        if bestDepth > 0:
+            self.hits += 1
+            self.stepsSaved += bestDepth
+            bestNode.lastUsed = self.clock
+        self.stepsSimulated += len(actionIds) - bestDepth
+        return best
+
+    def extend(self, node, actionId, state):
+        """Cache the state reached by appending actionId to the prefix at node.
+
+        :returns: The trie node of the extended prefix.
+        """
+        child = node.children.get(actionId)
+        if child is None:
+            child = _TrieNode(node, actionId)
+            node.children[actionId] = child
+        # Tick per state so that the states of one sequence are ordered too
+        self.clock += 1
+        child.state = state
+        child.lastUsed = self.clock
+        self.cached.add(child)
+
+        if len(self.cached) > self.maxStates:
+            self._evict(child)
+
+        return child
+
+    def clear(self):
+        self.root = _TrieNode()
+        self.cached.clear()
+
+    def hitRatio(self):
+        if self.lookups == 0:
+            return 0.0
+        return float(self.hits) / self.lookups
+
+    def _evict(self, active):
+        """Evict the least recently used states except that of *active*,
+        the node the caller is still extending, so it stays in the trie."""
+        keep = max(self.maxStates - self.maxStates // 4, 1)
+        byAge = sorted((node for node in self.cached if node is not active), key=lambda n: n.lastUsed)
+        for node in byAge[:len(self.cached) - keep]:
+            self.cached.discard(node)
+            node.state = None
+            # Remove branches that no longer lead to any cached state
+            while node.parent is not None and not node.children and node.state is None:
+                del node.parent.children[node.key]
+                node = node.parent
+
+
+class FitnessCache(object):
+    """Bounded memo of fitness values keyed by action id sequence.
+
+    Sequences are reduced to a canonical key before lookup. Trailing padding
+    actions never change the outcome, so they are stripped, except for the
+    first action: the empty sequence is penalised more than any other, so
+    a sequence of padding keeps one padding action. Once a synth is
+    finished every further action except padding is wasted and changes
+    nothing else, so the finished prefix of a stored sequence is remembered
+    too. Any sequence that extends it can then be answered from the prefix,
+    with the difference in wasted actions reported to the caller.
+
+    Entries are kept in two generations of at most *maxEntries* each. When
+    the current one is full it becomes the old one and the previous old
+    generation is dropped; entries found in the old generation are moved
+    back to the current one.
+    """
+    def __init__(self, maxEntries=100000, paddingId=None):
+        self.maxEntries = maxEntries
+        self.paddingId = paddingId
+        self.entries = {}
+        self.oldEntries = {}
+        self.finished = {}
+        self.oldFinished = {}
+        self.finishedLengths = []
+
+        # Statistics
+        self.lookups = 0
+        self.hits = 0
+        self.finishedHits = 0
+
+    def __len__(self):
+        return len(self.entries) + len(self.oldEntries) + len(self.finished) + len(self.oldFinished)
+
+    def key(self, actionIds):
+        """Canonical key of a sequence of action ids."""
+        end = len(actionIds)
+        while end > 1 and actionIds[end - 1] == self.paddingId:
+            end -= 1
+        return tuple(actionIds[:end])
+
+    def lookup(self, actionIds):
+        """Find the value of a sequence of action ids.
+
+        :returns: A (value, extraWasted) tuple where extraWasted is the number
+                  of wasted actions the sequence has in addition to the stored
+                  one, or None if the sequence is not cached.
+        """
+        self.lookups += 1
+        key = self.key(actionIds)
+
+        value = self._get(self.entries, self.oldEntries, key)
+        if value is not None:
+            self.hits += 1
+            return value, 0
+
+        for length in self.finishedLengths:
+            if length >= len(key):
+                break
+            prefix = key[:length]
+            found = self._get(self.finished, self.oldFinished, prefix)
+            if found is not None:
+                value, wasted = found
+                self.hits += 1
+                self.finishedHits += 1
+                return value, self._countWasted(key, length) - wasted
+
+        return None
+
+    def store(self, actionIds, value, finishStep=None):
+        """Cache the value of a sequence of action ids.
+
+        :param finishStep: Number of actions before the first one that was
+                           wasted because the synth was finished, if known.
+        """
+        key = self.key(actionIds)
+        self._put(self.entries, self.oldEntries, key, value)
+
+        if finishStep is not None and finishStep < len(key):
+            self._put(self.finished, self.oldFinished, key[:finishStep], (value, self._countWasted(key, finishStep)))
+            if finishStep not in self.finishedLengths:
+                bisect.insort(self.finishedLengths, finishStep)
+
+    def clear(self):
+        self.entries = {}
+        self.oldEntries = {}
+        self.finished = {}
+        self.oldFinished = {}
+        self.finishedLengths = []
+
+    def hitRatio(self):
+        if self.lookups == 0:
+            return 0.0
+        return float(self.hits) / self.lookups
+
+    def _countWasted(self, key, start):
+        return sum(1 for actionId in key[start:] if actionId != self.paddingId)
+
+    def _get(self, current, old, key):
+        value = current.get(key)
+        if value is None and key in old:
+            value = old.pop(key)
+            current[key] = value
+        return value
+
+    def _put(self, current, old, key, value):
+        current[key] = value
+        if len(current) > self.maxEntries:
+            old.clear()
+            old.update(current)
+            current.clear()
@@ -9,3 +9,8 @@ class StringLogOutput(object):
 
     def write(self, s):
         self.logText = self.logText + s
+
+
+class NullLogOutput(object):
+    def write(self, s):
+        pass
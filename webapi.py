@@ -4,12 +4,16 @@
 __author__ = 'Gordon Tyler <gordon@doxxx.net>'
 
 
+import collections
 import logging
+import threading
 import webapp2
 import json
 import random
 import main
 import async
+import exactsim
+import search
 from util import StringLogOutput
 
 
@@ -67,7 +71,32 @@ class SimulationHandler(BaseHandler):
             logOutput.write("\nMonte Carlo Result\n")
             logOutput.write("==================\n")
 
-            main.MonteCarloSim(sequence, synth, nRuns=settings['maxMontecarloRuns'], seed=seed, logOutput=logOutput)
+            result["monteCarlo"] = main.MonteCarloSim(sequence, synth, nRuns=settings['maxMontecarloRuns'], seed=seed,
+                                                      logOutput=logOutput, vectorized=True, hqMode="analytic",
+                                                      percentiles=(5, 50, 95), confidence=0.95,
+                                                      hqPrecision=settings.get('montecarloHqPrecision'),
+                                                      qualityPrecision=settings.get('montecarloQualityPrecision')).toDict()
+
+            if settings.get('exact', False):
+                # Bounded so that long sequences fall back to the Monte Carlo result instead of hanging the request
+                try:
+                    distribution = exactsim.exactSynth(sequence, synth,
+                                                       qualityResolution=settings.get('exactQualityResolution', 1),
+                                                       maxStates=settings.get('exactMaxStates', 5000))
+                except exactsim.TooManyStatesError as e:
+                    logOutput.write("\nExact Result\n")
+                    logOutput.write("============\n")
+                    logOutput.write("%s, use the Monte Carlo result instead.\n" % e)
+                    result["exactError"] = str(e)
+                else:
+                    result["exact"] = {
+                        "quality": distribution.expectedQuality,
+                        "minQuality": distribution.minQuality,
+                        "hqPercent": distribution.hqPercent,
+                        "failureProbability": distribution.failureProbability,
+                        "qualityDistribution": exactsim.bucketDistribution(distribution.qualityDistribution,
+                                                                           max(synth.recipe.maxQuality / 100.0, 1)),
+                    }
         except Exception as e:
             result["error"] = str(e)
             logging.exception(e)
@@ -142,7 +171,86 @@ class SolverHandler(BaseHandler):
             self.response.write(json.dumps(result))
 
 
+# Replanners of recent synths, kept warm between requests, least recently used first
+replanners = collections.OrderedDict()
+replannersLock = threading.Lock()
+maxReplanners = 32
+
+
+def getReplanner(settings):
+    """Warm :class:`search.Replanner` for the synth and solver settings of a
+    request, created if there is none yet."""
+    key = json.dumps([settings['crafter'], settings['recipe'], settings['maxTricksUses'],
+                      settings['solver']['penaltyWeight'], settings['solver'].get('maxLength', 50)], sort_keys=True)
+    with replannersLock:
+        replanner = replanners.pop(key, None)
+        if replanner is None:
+            crafterActions = [main.allActions[a] for a in settings['crafter']['actions']]
+            crafter = main.Crafter(settings['recipe']['cls'], settings['crafter']['level'], settings['crafter']['craftsmanship'],
+                                   settings['crafter']['control'], settings['crafter']['cp'], crafterActions)
+            recipe = main.Recipe(settings['recipe']['level'], settings['recipe']['difficulty'],
+                                 settings['recipe']['durability'], settings['recipe']['startQuality'],
+                                 settings['recipe']['maxQuality'])
+            synth = main.Synth(crafter, recipe, settings['maxTricksUses'], True)
+            replanner = search.Replanner(synth, settings['solver']['penaltyWeight'],
+                                         maxLength=settings['solver'].get('maxLength', 50))
+            if len(replanners) >= maxReplanners:
+                replanners.popitem(last=False)
+        replanners[key] = replanner
+        return replanner
+
+
+class ReplanHandler(BaseHandler):
+    def post(self):
+        settings = json.loads(self.request.body)
+        logging.debug("settings=" + repr(settings))
+
+        result = {}
+        logOutput = StringLogOutput()
+
+        try:
+            replanner = getReplanner(settings)
+
+            state = settings['state']
+            startState = main.liveFitnessState(replanner.synth, state['durability'], state['cp'], state['progress'],
+                                               state['quality'], iqStacks=state.get('iqStacks'),
+                                               effects=state.get('effects'), condition=state.get('condition', "normal"),
+                                               trickUses=state.get('trickUses', 0),
+                                               crossClassActions=[main.allActions[a] for a in state.get('crossClassActions', [])])
+
+            logOutput.write("Replanned Result\n")
+            logOutput.write("================\n")
+
+            best, finalState, _, _, _, runInfo = replanner.replan(startState, timeLimit=settings.get('timeLimit', 0.2),
+                                                                  logOutput=logOutput)
+
+            result["finalState"] = {
+                "durability": finalState.durabilityState,
+                "durabilityOk": finalState.durabilityOk,
+                "cp": finalState.cpState,
+                "cpOk": finalState.cpOk,
+                "progress": finalState.progressState,
+                "progressOk": finalState.progressOk,
+                "quality": finalState.qualityState,
+            }
+            result["bestSequence"] = [a.shortName for a in best]
+            result["beamWidth"] = runInfo["beamWidth"]
+            result["seconds"] = runInfo["seconds"]
+        except Exception as e:
+            result["error"] = str(e)
+            logging.exception(e)
+            self.response.status = 500
+
+        result["log"] = logOutput.logText
+
+        logging.debug("result=" + repr(result))
+
+        self.writeHeaders()
+        self.response.write(json.dumps(result))
+
+
 application = webapp2.WSGIApplication([
     ('/simulation', SimulationHandler),
     ('/solver', SolverHandler),
+    ('/replan', ReplanHandler),
 ], debug=__debug__)